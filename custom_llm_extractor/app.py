@@ -1,7 +1,19 @@
 import streamlit as st
-import PyPDF2
+import io
 import json
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from cache import ResultCache, pdf_digest
+from extract_text import PageStore, iter_pdf_pages, pdf_page_count
+from incremental import run_incremental_extraction
+from jobs import FINISHED, JobQueue
+from keyword_index import KeywordIndex
+from metrics import METRICS, METRICS_FILE, Metrics
+from cpu_backend import BACKENDS, DEFAULT_COMPILE
+from model_registry import get_pipeline
+from prefix_cache import PrefixCache
+from prompts import PromptBuilder
+from retrieval import EmbeddingStore, Retriever
+from rules import RuleExtractor
+from tender_pipeline import MEMORY_BUDGET_MB, iter_streaming_extraction, run_extraction
 
 # Criteria schema (same as in infer_llm.py)
 CRITERIA = {
@@ -134,14 +146,32 @@ CRITERIA = {
     }
 }
 
-def extract_text_from_pdf(pdf_file):
-    text = ""
-    reader = PyPDF2.PdfReader(pdf_file)
-    for page in reader.pages:
-        page_text = page.extract_text()
-        if page_text:
-            text += page_text + "\n"
-    return text
+KEYWORD_INDEX = KeywordIndex(CRITERIA)
+RULES = RuleExtractor(CRITERIA)
+# Characters of a page shown in the text preview
+PREVIEW_CHARS = 5000
+
+@st.cache_resource
+def get_cache():
+    return ResultCache()
+
+@st.cache_resource
+def get_prefix_cache():
+    return PrefixCache()
+
+@st.cache_resource
+def get_retriever():
+    return Retriever(CRITERIA, store=EmbeddingStore())
+
+def get_page_store(pdf):
+    # Low-memory mode: the uploaded PDF's pages are spilled to disk once per session rather
+    # than kept in the page cache and in session memory
+    key = f"page_store:{pdf_digest(pdf)}"
+    if key not in st.session_state:
+        for old in [k for k in st.session_state if str(k).startswith("page_store:")]:
+            st.session_state.pop(old).close()
+        st.session_state[key] = PageStore(iter_pdf_pages(pdf))
+    return st.session_state[key]
 
 def build_prompt(text, criteria):
     return f"""
@@ -158,44 +188,193 @@ Text chunk:
 Respond in JSON format matching the criteria structure.
 """
 
-def flatten_dict(d, parent_key='', sep=' > '):
-    items = []
-    for k, v in d.items():
-        new_key = f"{parent_key}{sep}{k}" if parent_key else k
-        if isinstance(v, dict):
-            items.extend(flatten_dict(v, new_key, sep=sep))
-        else:
-            items.append((new_key, v))
-    return items
+def run_job(request, document, report):
+    # Background job runner (see jobs.py): the same extraction as the button below, with
+    # progress and the partial merged result saved after every chunk
+    metrics = Metrics()
+    with metrics.sampling_rss():
+        with metrics.timer("pdf_parse"):
+            if request.get("low_memory"):
+                pages = PageStore(iter_pdf_pages(io.BytesIO(document)))
+            else:
+                pages = list(get_cache().cached_pages(io.BytesIO(document), iter_pdf_pages))
+        # last_page is a PDF page number, so it is compared with the PDF's page count, which
+        # also counts the pages without text
+        progress = {"chunks": 0, "pages": pdf_page_count(io.BytesIO(document)), "last_page": 0}
+        report(progress)
+
+        def on_chunk(_, output, merger):
+            progress["chunks"] += 1
+            progress["last_page"] = max([progress["last_page"], *output["pages"]])
+            report(dict(progress), merger.result())
+
+        nlp = get_pipeline(request["model_name"], backend=request["backend"], compile=request.get("compile", False),
+                           draft=request.get("draft"))
+        try:
+            extraction = run_extraction(pages, nlp, CRITERIA, build_prompt, keyword_index=KEYWORD_INDEX,
+                                        prompt_builder=PromptBuilder(nlp.tokenizer, CRITERIA), cache=get_cache(),
+                                        constrained=request["constrained"], prefix_cache=get_prefix_cache(),
+                                        metrics=metrics, rules=RULES if request["rules"] else None,
+                                        retriever=get_retriever() if request["retrieval"] else None, on_chunk=on_chunk,
+                                        memory_budget=request.get("memory_budget_mb", 0) * 2**20)
+        finally:
+            if isinstance(pages, PageStore):
+                pages.close()
+    # Keyword filtering may skip the last pages, so the run's end is reported explicitly
+    progress["last_page"] = progress["pages"]
+    report(progress, extraction["result"])
+    METRICS.record(metrics)
+    return {
+        "result": extraction["result"],
+        "provenance": extraction["provenance"],
+        "chunks": [{k: c[k] for k in ("chunk", "pages", "output", "parsed")} for c in extraction["chunks"]],
+        "metrics": metrics.as_dict(),
+    }
+
+@st.cache_resource
+def get_jobs():
+    # Shared by every session; jobs left unfinished by a previous run start again here
+    return JobQueue(run_job, kind="streamlit")
+
+def show_extraction(extraction, report):
+    json_data = extraction["result"]
+    st.subheader("Extracted Information (JSON)")
+    st.json(json_data)
+    st.subheader("Tabular View")
+    # One row per distinct finding, with the pages and chunks it came from
+    st.dataframe([
+        dict(row, value=row["value"] if isinstance(row["value"], str) else json.dumps(row["value"]),
+             pages=", ".join(map(str, row["pages"])), chunks=", ".join(map(str, row["chunks"])))
+        for row in extraction["provenance"]
+    ], use_container_width=True)
+
+    failed = [c for c in extraction["chunks"] if c["parsed"] is None]
+    if failed:
+        with st.expander(f"Could not parse JSON from {len(failed)} of {len(extraction['chunks'])} chunks"):
+            for c in failed:
+                st.text(f"Chunk {c['chunk']}:\n{c['output']}")
+
+    with st.expander("Performance"):
+        st.table([{"stage": stage, "seconds": seconds} for stage, seconds in report["seconds"].items()])
+        st.table([{"counter": name, "value": value} for name, value in report["counts"].items()])
+        if "peak_rss_mb" in report:
+            st.table([{"stage": stage, "peak RSS (MB)": mb} for stage, mb in report["peak_rss_mb"].items()])
+        if "draft_acceptance_rate" in report:
+            st.write(f"Draft tokens accepted: {report['draft_acceptance_rate']:.0%}")
 
 st.title("Custom LLM Tender Document Extractor (Lightweight Model)")
 
 uploaded_file = st.file_uploader("Upload a Tender PDF", type=["pdf"])
 
 if uploaded_file is not None:
-    with st.spinner("Extracting text from PDF..."):
-        text = extract_text_from_pdf(uploaded_file)
+    low_memory = st.checkbox("Low-memory mode (keep page text on disk; for very large PDFs)",
+                             value=bool(MEMORY_BUDGET_MB))
+    metrics = Metrics()
+    with st.spinner("Extracting text from PDF..."), metrics.sampling_rss(), metrics.timer("pdf_parse"):
+        if low_memory:
+            pages = get_page_store(uploaded_file)
+        else:
+            pages = list(get_cache().cached_pages(uploaded_file, iter_pdf_pages))
     st.success("Text extracted from PDF.")
-    st.text_area("Extracted Text", text, height=200)
+    # One page at a time: the whole text of a large tender is too much for a text area
+    if len(pages):
+        preview = st.number_input(f"Preview page (1-{len(pages)})", min_value=1, max_value=len(pages), value=1)
+        page_number, page_text = pages[preview - 1]
+        st.text_area(f"Extracted Text (PDF page {page_number})", page_text[:PREVIEW_CHARS], height=200)
+    memory_budget_mb = 0
+    if low_memory:
+        memory_budget_mb = st.number_input("Peak memory budget (MB)", min_value=0, value=MEMORY_BUDGET_MB or 2048)
+
+    model_name = st.selectbox("Model", ["distilgpt2", "gpt2-medium", "TinyLlama/TinyLlama-1.1B-Chat-v1.0"])
+    # The draft model must share the chosen model's tokenizer (distilgpt2 for the GPT-2 family)
+    draft = st.selectbox("Draft model for assisted generation", ["none", "distilgpt2"])
+    draft = None if draft == "none" or draft == model_name else draft
+    backend = st.selectbox("CPU backend", BACKENDS)
+    compile_model = st.checkbox("Compile the model with torch.compile (slow first run)", value=DEFAULT_COMPILE)
+    stream_output = st.checkbox("Stream model output", value=True)
+    constrained = st.checkbox("Constrain output to the criteria JSON schema", value=True)
+    use_rules = st.checkbox("Read amounts, percentages and periods with rules (LLM only when unsure)", value=True)
+    use_retrieval = st.checkbox("Send only the best-matching passages per heading (semantic retrieval)")
+    tender_id = st.text_input("Tender ID (optional: re-infer only pages changed since the last run with this ID)")
+    background = st.checkbox("Run as a background job (for long tenders; the page stays responsive)")
 
     if st.button("Run LLM Extraction"):
-        with st.spinner("Loading lightweight LLM and extracting..."):
-            model_name = "distilgpt2"  # Change to "TinyLlama/TinyLlama-1.1B-Chat-v1.0" if available
-            tokenizer = AutoTokenizer.from_pretrained(model_name)
-            model = AutoModelForCausalLM.from_pretrained(model_name)
-            nlp = pipeline("text-generation", model=model, tokenizer=tokenizer)
-
-            prompt = build_prompt(text, CRITERIA)
-            response = nlp(prompt, max_new_tokens=1024)[0]['generated_text']
-
-            # Try to parse JSON from response
-            try:
-                json_start = response.find("{")
-                json_data = json.loads(response[json_start:])
-                st.subheader("Extracted Information (JSON)")
-                st.json(json_data)
-                flat = flatten_dict(json_data)
-                st.subheader("Tabular View")
-                st.table(flat)
-            except Exception as e:
-                st.error(f"Could not parse JSON from LLM output. Raw output below:\n\n{response}")
+        if background:
+            st.session_state["job_id"] = get_jobs().submit(
+                {"model_name": model_name, "backend": backend, "compile": compile_model, "draft": draft,
+                 "constrained": constrained, "rules": use_rules, "retrieval": use_retrieval, "low_memory": low_memory,
+                 "memory_budget_mb": memory_budget_mb},
+                uploaded_file.getvalue(),
+            )
+        else:
+            with st.spinner("Loading lightweight LLM and extracting..."), metrics.sampling_rss():
+                # Loaded once per process and shared across sessions and reruns
+                nlp = get_pipeline(model_name, backend=backend, compile=compile_model, draft=draft)
+                prompt_builder = PromptBuilder(nlp.tokenizer, CRITERIA)
+                rules = RULES if use_rules else None
+                retriever = get_retriever() if use_retrieval else None
+
+                if tender_id:
+                    extraction = run_incremental_extraction(tender_id, pages, nlp, CRITERIA, build_prompt,
+                                                            get_cache(), keyword_index=KEYWORD_INDEX,
+                                                            prompt_builder=prompt_builder, constrained=constrained,
+                                                            prefix_cache=get_prefix_cache(), metrics=metrics,
+                                                            rules=rules, retriever=retriever,
+                                                            memory_budget=memory_budget_mb * 2**20)
+                elif stream_output:
+                    live = st.empty()
+                    streamed = ""
+                    for event in iter_streaming_extraction(pages, nlp, CRITERIA, build_prompt,
+                                                           keyword_index=KEYWORD_INDEX, prompt_builder=prompt_builder,
+                                                           cache=get_cache(), constrained=constrained,
+                                                           prefix_cache=get_prefix_cache(), metrics=metrics,
+                                                           rules=rules, retriever=retriever):
+                        if event["event"] == "token":
+                            streamed += event["text"]
+                            live.code(f"Chunk {event['chunk']}:\n{streamed}")
+                        elif event["event"] == "chunk":
+                            streamed = ""
+                        else:
+                            extraction = event
+                    live.empty()
+                else:
+                    extraction = run_extraction(pages, nlp, CRITERIA, build_prompt, keyword_index=KEYWORD_INDEX,
+                                                prompt_builder=prompt_builder, cache=get_cache(),
+                                                constrained=constrained, prefix_cache=get_prefix_cache(),
+                                                metrics=metrics, rules=rules, retriever=retriever,
+                                                memory_budget=memory_budget_mb * 2**20)
+                METRICS.record(metrics)
+                if METRICS_FILE:
+                    METRICS.write(METRICS_FILE, {"result": get_cache(), "prefix": get_prefix_cache(),
+                                                 "embeddings": get_retriever().store})
+
+            if tender_id and extraction["previous_version"]:
+                changed = ", ".join(extraction["changed_fields"]) or "none"
+                st.info(f"Corrigendum: re-inferred {len(extraction['changed_pages'])} changed page(s), "
+                        f"reused {extraction['reused_chunks']} chunk(s). Changed fields: {changed}")
+            show_extraction(extraction, metrics.as_dict())
+
+# Background jobs outlive the session (and a restart), so they can be looked up by id
+job_id = st.text_input("Background job ID", value=st.session_state.get("job_id", ""))
+if job_id:
+    job = get_jobs().status(job_id)
+    if job is None:
+        st.warning(f"No job {job_id}")
+    else:
+        progress = job["progress"] or {}
+        st.write(f"Job {job_id}: **{job['status']}**, {progress.get('chunks', 0)} chunk(s) merged, "
+                 f"page {progress.get('last_page', 0)} of {progress.get('pages', '?')}")
+        if progress.get("pages"):
+            st.progress(min(1.0, progress.get("last_page", 0) / progress["pages"]))
+        refresh, cancel = st.columns(2)
+        refresh.button("Refresh")
+        if job["status"] not in FINISHED and cancel.button("Cancel job"):
+            get_jobs().cancel(job_id)
+            st.rerun()
+        if job["error"]:
+            st.error(job["error"])
+        if job["result"] is not None:
+            show_extraction(job["result"], job["result"]["metrics"])
+        elif job["partial"] is not None:
+            st.subheader("Partial result")
+            st.json(job["partial"])
@@ -0,0 +1,238 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import ResultCache
+from extract_text import PageStore, iter_pdf_pages, load_document
+from infer_llm import CRITERIA, KEYWORD_INDEX, RULES, build_prompt
+from prompts import PromptBuilder
+
+# Corpus-scale extraction in one process: documents from a directory or manifest are
+# parsed in a process pool while the single loaded model works through earlier ones.
+# Results are appended to a JSONL file, one line per document, which doubles as the
+# checkpoint: rerunning with the same output skips documents that already succeeded.
+# torch/transformers are imported in run() and main(), not at import time: the spawned
+# parsing workers re-import this script and should only need extract_text.
+DOCUMENT_SUFFIXES = (".pdf", ".txt")
+DOCS_PER_BATCH = 4
+
+
+def find_documents(source):
+    # source is a directory (searched recursively for PDFs and text files) or a manifest
+    # with one path per line; blank lines and lines starting with # are ignored
+    if os.path.isdir(source):
+        paths = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            paths.extend(
+                os.path.join(root, name) for name in sorted(files) if name.lower().endswith(DOCUMENT_SUFFIXES)
+            )
+        return paths
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base, line) for line in lines if line and not line.startswith("#")]
+
+
+def completed_documents(output_path):
+    # Paths already written successfully; a line cut short by an interrupted run is
+    # truncated away so new records start on a clean line
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    good_bytes = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            good_bytes += len(line)
+            if "error" not in record:
+                done.add(record["path"])
+    if good_bytes < os.path.getsize(output_path):
+        with open(output_path, "r+b") as f:
+            f.truncate(good_bytes)
+    return done
+
+
+def iter_loaded(paths, workers, prefetch_docs):
+    # Yield (path, document, error) in input order, keeping at most prefetch_docs
+    # documents being parsed ahead of the consumer
+    # spawn rather than fork: the model and its torch threads are already loaded
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = deque()
+        paths = iter(paths)
+        for path in paths:
+            pending.append((path, pool.submit(load_document, path)))
+            if len(pending) >= prefetch_docs:
+                break
+        while pending:
+            path, future = pending.popleft()
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append((next_path, pool.submit(load_document, next_path)))
+            try:
+                yield path, future.result(), None
+            except Exception as e:
+                yield path, None, e
+
+
+def iter_spilled(paths):
+    # Low-memory mode: parse one document at a time in this process, PDFs straight into a
+    # PageStore on disk, instead of holding several parsed documents from the pool
+    for path in paths:
+        try:
+            if path.lower().endswith(".pdf"):
+                document = PageStore(iter_pdf_pages(path))
+            else:
+                document = load_document(path)
+        except Exception as e:
+            yield path, None, e
+        else:
+            yield path, document, None
+
+
+def _record(path, extraction, seconds):
+    return {
+        "path": path,
+        "result": extraction["result"],
+        "chunks": len(extraction["chunks"]),
+        "unparsed_chunks": sum(1 for c in extraction["chunks"] if c["parsed"] is None),
+        "seconds": round(seconds, 3),
+    }
+
+
+def run(paths, output_path, nlp, workers=None, docs_per_batch=DOCS_PER_BATCH, batch_size=None,
+        cache=None, constrained=True, replicas=None, rules=RULES, retriever=None, memory_budget=None,
+        log=sys.stderr):
+    # Extract every path not yet recorded in output_path; chunks of up to docs_per_batch
+    # documents share generation batches (of batch_size chunks, default
+    # tender_pipeline.BATCH_SIZE), spread over a ReplicaPool when one is given.
+    # With a memory_budget (bytes), documents are parsed serially into on-disk page stores
+    # and generation batches are sized to the budget. Returns (succeeded, failed) counts.
+    from prefix_cache import PrefixCache
+    from tender_pipeline import BATCH_SIZE, run_batch_extraction
+
+    batch_size = batch_size or BATCH_SIZE
+    done = completed_documents(output_path)
+    todo = [p for p in paths if p not in done]
+    if done:
+        print(f"Resuming: {len(paths) - len(todo)} of {len(paths)} documents already done", file=log)
+    workers = workers or os.cpu_count() or 1
+    prompt_builder = PromptBuilder(nlp.tokenizer, CRITERIA)
+    prefix_cache = PrefixCache()
+    succeeded = failed = 0
+
+    with open(output_path, "a", encoding="utf-8") as out:
+        def write(record):
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+
+        group = []
+
+        def flush_group():
+            nonlocal succeeded, failed
+            if not group:
+                return
+            start = time.perf_counter()
+            try:
+                extractions = run_batch_extraction(
+                    [document for _, document in group], nlp, CRITERIA, build_prompt,
+                    keyword_index=KEYWORD_INDEX, prompt_builder=prompt_builder, batch_size=batch_size,
+                    cache=cache, constrained=constrained, prefix_cache=prefix_cache, replicas=replicas,
+                    rules=rules, retriever=retriever, memory_budget=memory_budget,
+                )
+            except Exception as e:
+                for path, _ in group:
+                    write({"path": path, "error": f"{type(e).__name__}: {e}"})
+                failed += len(group)
+            else:
+                seconds = (time.perf_counter() - start) / len(group)
+                for (path, _), extraction in zip(group, extractions):
+                    write(_record(path, extraction, seconds))
+                succeeded += len(group)
+            print(f"{succeeded + failed}/{len(todo)} documents ({failed} failed)", file=log)
+            for _, document in group:
+                if isinstance(document, PageStore):
+                    document.close()
+            group.clear()
+
+        if memory_budget:
+            loaded = iter_spilled(todo)
+        else:
+            loaded = iter_loaded(todo, workers, prefetch_docs=max(workers, docs_per_batch) * 2)
+        for path, document, error in loaded:
+            if error is not None:
+                write({"path": path, "error": f"{type(error).__name__}: {error}"})
+                failed += 1
+                continue
+            group.append((path, document))
+            if len(group) >= docs_per_batch:
+                flush_group()
+        flush_group()
+    return succeeded, failed
+
+
+def main():
+    from cpu_backend import BACKENDS, DEFAULT_BACKEND, DEFAULT_COMPILE
+    from model_registry import DEFAULT_MODEL, DRAFT_MODEL, get_pipeline
+    from replicas import DEFAULT_THREADS_PER_REPLICA, ReplicaPool
+    from retrieval import EmbeddingStore, Retriever
+    from tender_pipeline import BATCH_SIZE, MEMORY_BUDGET_MB
+
+    parser = argparse.ArgumentParser(description="Extract tender criteria from a directory or manifest of documents")
+    parser.add_argument("source", help="directory of .pdf/.txt files, or a manifest with one path per line")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL results file, also used to resume")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--backend", choices=BACKENDS, default=DEFAULT_BACKEND)
+    parser.add_argument("--compile", action="store_true", default=DEFAULT_COMPILE,
+                        help="wrap the model's forward pass in torch.compile (default: TENDER_LLM_COMPILE=1)")
+    parser.add_argument("--draft-model", default=DRAFT_MODEL,
+                        help="smaller model with the same tokenizer that drafts tokens for assisted generation")
+    parser.add_argument("--workers", type=int, default=None, help="PDF parsing processes (default: CPU count)")
+    parser.add_argument("--docs-per-batch", type=int, default=DOCS_PER_BATCH)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the generation cache")
+    parser.add_argument("--no-rules", action="store_true",
+                        help="ask the model for every field instead of reading amounts and periods with rules")
+    parser.add_argument("--retrieve", type=int, default=0, metavar="K",
+                        help="send only the K passages per heading that rank highest by embedding similarity")
+    parser.add_argument("--replicas", type=int, default=0,
+                        help="generate on N model replicas in worker processes (-1: one per core slice)")
+    parser.add_argument("--threads-per-replica", type=int, default=DEFAULT_THREADS_PER_REPLICA)
+    parser.add_argument("--memory-budget-mb", type=int, default=MEMORY_BUDGET_MB,
+                        help="low-memory mode: spill page text to disk and size batches to this peak RSS")
+    args = parser.parse_args()
+
+    paths = find_documents(args.source)
+    cache = None if args.no_cache else ResultCache()
+    replicas = None
+    model = args.model
+    if args.replicas:
+        replicas = ReplicaPool(args.model, args.replicas if args.replicas > 0 else None,
+                               args.threads_per_replica, args.backend, args.draft_model, args.compile)
+        # Chunking and prompt building here use the same memory-mapped snapshot as the replicas
+        model = replicas.model_name
+    nlp = get_pipeline(model, backend=args.backend, compile=args.compile, draft=args.draft_model)
+    try:
+        succeeded, failed = run(paths, args.output, nlp, args.workers, args.docs_per_batch, args.batch_size,
+                                cache, replicas=replicas, rules=None if args.no_rules else RULES,
+                                retriever=Retriever(CRITERIA, args.retrieve, EmbeddingStore()) if args.retrieve else None,
+                                memory_budget=args.memory_budget_mb * 2**20)
+    finally:
+        if replicas is not None:
+            replicas.close()
+    print(f"Done: {succeeded} extracted, {failed} failed; results in {args.output}", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import tempfile
+import time
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast, pipeline
+
+from cpu_backend import BACKENDS, configure_threads, prepare_model
+from extract_text import iter_pdf_pages
+from infer_llm import CRITERIA, KEYWORD_INDEX, build_prompt
+from keyword_index import heading_paths
+from merging import merge_results, parse_json_response
+from metrics import PeakRss
+from prefix_cache import PrefixCache
+from prompts import PromptBuilder
+from tender_pipeline import BATCH_SIZE, MAX_NEW_TOKENS, fit_max_new_tokens, generate_batch, iter_document_chunks, prepare_batching
+
+# Offline, reproducible benchmark of the extraction pipeline. Synthetic tender PDFs are
+# written locally and generation runs on a tiny randomly initialised GPT-2 with a BPE
+# tokenizer trained on the same synthetic text, so nothing is downloaded. Each stage
+# (PDF extraction, chunking + prompt building, generation, JSON parsing + merging)
+# reports throughput, p50/p95 latency and peak RSS to a JSON file for comparing runs.
+DEFAULT_OUTPUT = "benchmark_results.json"
+TINY_GPT2 = dict(n_layer=2, n_head=2, n_embd=128, n_positions=1024)
+TOKENIZER_VOCAB = 2000
+
+FILLER = [
+    "The contractor shall comply with all applicable labour laws and safety regulations.",
+    "All drawings and specifications form an integral part of this contract.",
+    "The Engineer-in-Charge may issue further instructions during execution of the work.",
+    "Materials brought to site shall not be removed without written permission.",
+    "Bids received after the due date and time shall be summarily rejected.",
+    "The rates quoted shall be inclusive of all taxes, duties and levies.",
+    "Site clearance and disposal of surplus earth shall be at the contractor's cost.",
+    "Any dispute arising out of this contract shall be subject to local jurisdiction.",
+]
+
+
+def synthetic_tender_text(rng, n_pages):
+    # Tender-like pages: numbered clauses quoting CRITERIA keywords with amounts, periods
+    # and percentages in the formats real tenders use, mixed with irrelevant boilerplate
+    keywords = [keyword for _, words in heading_paths(CRITERIA) for keyword in words]
+    pages = []
+    clause = 1
+    for _ in range(n_pages):
+        lines = []
+        while len(lines) < 40:
+            keyword = rng.choice(keywords)
+            lines.append(f"Clause {clause}. {keyword.title()}")
+            clause += 1
+            lines.append(
+                f"The bidder shall furnish {keyword} of Rs. {rng.randint(1, 99)},{rng.randint(10, 99)},000/- "
+                f"({rng.randint(1, 50)} lakh) within {rng.randint(7, 90)} days, being "
+                f"{rng.choice([2, 2.5, 3, 5, 10])}% of the contract value, valid for {rng.randint(6, 36)} months."
+            )
+            lines.extend(rng.sample(FILLER, 3))
+            lines.append("")
+        pages.append(lines)
+    return pages
+
+
+def _pdf_string(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages):
+    # Minimal PDF writer (Helvetica text, one content stream per page) so benchmarks do not
+    # depend on a PDF-generation library; PyPDF2 extracts the text back line by line
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_refs = []
+    for lines in pages:
+        body = "BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"({_pdf_string(line)}) Tj T*" for line in lines) + " ET"
+        stream = body.encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_ref = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_ref
+        )
+        page_refs.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(page_refs), len(page_refs))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def synthetic_corpus(directory, n_documents, pages_per_document, seed=0):
+    rng = random.Random(seed)
+    paths, texts = [], []
+    for i in range(n_documents):
+        pages = synthetic_tender_text(rng, pages_per_document)
+        path = os.path.join(directory, f"tender_{i:03d}.pdf")
+        write_pdf(path, pages)
+        paths.append(path)
+        texts.extend("\n".join(lines) for lines in pages)
+    return paths, texts
+
+
+def tiny_pipeline(corpus, backend="fp32", seed=0, compile=False):
+    # Randomly initialised GPT-2 with a byte-level BPE trained on the synthetic corpus and
+    # the prompt text; its output is noise, but the compute per token is real
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    torch.manual_seed(seed)
+    bpe = Tokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=TOKENIZER_VOCAB,
+        special_tokens=["<|endoftext|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    bpe.train_from_iterator(list(corpus) + [build_prompt("", CRITERIA), json.dumps(CRITERIA)], trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe, eos_token="<|endoftext|>", bos_token="<|endoftext|>")
+    tokenizer.model_max_length = TINY_GPT2["n_positions"]
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        **TINY_GPT2,
+    )
+    model = GPT2LMHeadModel(config)
+    model.config.name_or_path = "benchmark-tiny-gpt2"
+    model, backend, _ = prepare_model(model, tokenizer, backend, compile)
+    nlp = pipeline("text-generation", model=model, tokenizer=tokenizer)
+    nlp.backend = backend
+    return nlp
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest-rank percentile
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def _stage(latencies, seconds, peak_rss, pages=None, tokens=None, **extra):
+    stats = {
+        "items": len(latencies),
+        "seconds": round(seconds, 4),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+        "peak_rss_mb": round(peak_rss / 2**20, 1),
+    }
+    if pages is not None:
+        stats["pages"] = pages
+        stats["pages_per_sec"] = round(pages / seconds, 2) if seconds else None
+    if tokens is not None:
+        stats["tokens"] = tokens
+        stats["tokens_per_sec"] = round(tokens / seconds, 1) if seconds else None
+    stats.update(extra)
+    return stats
+
+
+def run_benchmark(documents=4, pages=8, batch_size=BATCH_SIZE, max_new_tokens=MAX_NEW_TOKENS,
+                  targeted=True, constrained=True, backend="fp32", seed=0, compile=False):
+    configure_threads()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths, corpus = synthetic_corpus(directory, documents, pages, seed)
+        nlp = tiny_pipeline(corpus, backend, seed, compile)
+        prepare_batching(nlp.tokenizer, nlp.model)
+        prompt_builder = PromptBuilder(nlp.tokenizer, CRITERIA) if targeted else None
+        # The full prompt leaves less room, so generation may be shortened to fit the window
+        max_new_tokens = fit_max_new_tokens(nlp, CRITERIA, build_prompt, max_new_tokens, prompt_builder)
+
+        # PDF -> pages
+        latencies, parsed, n_pages = [], [], 0
+        with PeakRss() as rss:
+            start = time.perf_counter()
+            for path in paths:
+                t = time.perf_counter()
+                doc_pages = list(iter_pdf_pages(path))
+                latencies.append(time.perf_counter() - t)
+                parsed.append(doc_pages)
+                n_pages += len(doc_pages)
+            seconds = time.perf_counter() - start
+        results["pdf_extract"] = _stage(latencies, seconds, rss.peak, pages=n_pages)
+
+        # pages -> keyword filter, chunks and prompt token ids
+        latencies, chunked, prompt_tokens = [], [], 0
+        with PeakRss() as rss:
+            start = time.perf_counter()
+            for doc_pages in parsed:
+                t = time.perf_counter()
+                chunks = list(iter_document_chunks(doc_pages, nlp, CRITERIA, build_prompt, max_new_tokens,
+                                                   keyword_index=KEYWORD_INDEX, prompt_builder=prompt_builder))
+                latencies.append(time.perf_counter() - t)
+                chunked.append(chunks)
+                prompt_tokens += sum(len(c["input_ids"]) for c in chunks)
+            seconds = time.perf_counter() - start
+        results["prompt"] = _stage(latencies, seconds, rss.peak, pages=n_pages, tokens=prompt_tokens,
+                                   chunks=sum(len(c) for c in chunked))
+
+        # prompts -> generated text, in padded batches sharing the prefix KV cache
+        all_chunks = [chunk for chunks in chunked for chunk in chunks]
+        prefix_cache = PrefixCache()
+        latencies, generated_tokens = [], 0
+        with PeakRss() as rss:
+            start = time.perf_counter()
+            for i in range(0, len(all_chunks), batch_size):
+                batch = all_chunks[i:i + batch_size]
+                groups = {}
+                for chunk in batch:
+                    groups.setdefault(tuple(chunk["input_ids"][:chunk["prefix_len"]]), []).append(chunk)
+                t = time.perf_counter()
+                for group in groups.values():
+                    texts = generate_batch(
+                        nlp, [c["input_ids"] for c in group], max_new_tokens,
+                        [c["schema"] for c in group] if constrained else None,
+                        group[0]["prefix_len"], prefix_cache,
+                    )
+                    for chunk, text in zip(group, texts):
+                        chunk["output"] = text
+                        generated_tokens += len(nlp.tokenizer(text, add_special_tokens=False)["input_ids"])
+                latencies.append(time.perf_counter() - t)
+            seconds = time.perf_counter() - start
+        results["generate"] = _stage(latencies, seconds, rss.peak, tokens=generated_tokens,
+                                     prompt_tokens=prompt_tokens, batches=len(latencies))
+
+        # generated text -> parsed JSON merged per document
+        latencies, unparsed = [], 0
+        with PeakRss() as rss:
+            start = time.perf_counter()
+            for chunks in chunked:
+                t = time.perf_counter()
+                found = [parse_json_response(c["output"]) for c in chunks]
+                merge_results([r for r in found if r is not None], CRITERIA)
+                latencies.append(time.perf_counter() - t)
+                unparsed += sum(1 for r in found if r is None)
+            seconds = time.perf_counter() - start
+        results["parse"] = _stage(latencies, seconds, rss.peak, unparsed_chunks=unparsed)
+
+    return {
+        "config": {
+            "documents": documents, "pages_per_document": pages, "batch_size": batch_size,
+            "max_new_tokens": max_new_tokens, "targeted": targeted, "constrained": constrained,
+            "backend": nlp.backend, "compile": compile, "seed": seed, "model": TINY_GPT2,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpus": os.cpu_count(),
+            "threads": torch.get_num_threads(),
+            "platform": platform.platform(),
+        },
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "stages": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the tender extraction pipeline")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--documents", type=int, default=4)
+    parser.add_argument("--pages", type=int, default=8, help="pages per synthetic document")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    parser.add_argument("--full-prompt", action="store_true",
+                        help="send the full CRITERIA prompt with every chunk (--max-new-tokens is cut to fit)")
+    parser.add_argument("--unconstrained", action="store_true")
+    parser.add_argument("--backend", choices=BACKENDS, default="fp32")
+    parser.add_argument("--compile", action="store_true", help="wrap the model's forward pass in torch.compile")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    report = run_benchmark(args.documents, args.pages, args.batch_size, args.max_new_tokens,
+                           not args.full_prompt, not args.unconstrained, args.backend, args.seed, args.compile)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    for name, stats in report["stages"].items():
+        rate = f"{stats['tokens_per_sec']} tok/s" if "tokens_per_sec" in stats else f"{stats.get('pages_per_sec')} pages/s"
+        print(f"{name:12s} {stats['seconds']:8.3f}s  p50 {stats['p50_ms']}ms  p95 {stats['p95_ms']}ms  "
+              f"{rate}  peak {stats['peak_rss_mb']}MB")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
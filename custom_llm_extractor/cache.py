@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Persistent, size-bounded LRU cache shared by the CLI, the Streamlit app and the handler.
+# Entries are content-addressed: extracted pages by the PDF's hash, generations by
+# hash(model name + prompt token ids + generation params); document versions (page
+# fingerprints and chunk outputs, for incremental corrigendum runs) by a caller-chosen id.
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "tender_llm", "cache.sqlite")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# The store's total size is tracked as entries are written; other processes writing the
+# same file make it drift, so it is recounted from the table every this many writes
+RECOUNT_WRITES = 256
+
+PAGES = "pages"
+GENERATION = "generation"
+DOCUMENTS = "document"
+
+
+def pdf_digest(pdf):
+    # pdf may be a path, raw bytes or a binary file object (left rewound)
+    digest = hashlib.sha256()
+    if isinstance(pdf, (bytes, bytearray)):
+        digest.update(pdf)
+    elif isinstance(pdf, (str, os.PathLike)):
+        with open(pdf, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    else:
+        pdf.seek(0)
+        for block in iter(lambda: pdf.read(1 << 20), b""):
+            digest.update(block)
+        pdf.seek(0)
+    return digest.hexdigest()
+
+
+def generation_key(model_name, input_ids, params):
+    payload = json.dumps([model_name, list(input_ids), params], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path or os.environ.get("TENDER_LLM_CACHE", DEFAULT_CACHE_PATH)
+        self.max_bytes = max_bytes
+        self.hits = {PAGES: 0, GENERATION: 0, DOCUMENTS: 0}
+        self.misses = {PAGES: 0, GENERATION: 0, DOCUMENTS: 0}
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_access REAL NOT NULL, PRIMARY KEY (kind, key))"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access)")
+        self._writes = 0
+        self._total = self._count_bytes()
+
+    def _count_bytes(self):
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, kind, key):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM entries WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+            if row is None:
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+                return None
+            with self._db:
+                self._db.execute(
+                    "UPDATE entries SET last_access = ? WHERE kind = ? AND key = ?", (time.time(), kind, key)
+                )
+            self.hits[kind] = self.hits.get(kind, 0) + 1
+            return json.loads(row[0])
+
+    def put(self, kind, key, value):
+        value = json.dumps(value)
+        with self._lock, self._db:
+            old = self._db.execute("SELECT size FROM entries WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (kind, key, value, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (kind, key, value, len(value), time.time()),
+            )
+            self._writes += 1
+            if self._writes % RECOUNT_WRITES == 0:
+                self._total = self._count_bytes()
+            else:
+                self._total += len(value) - (old[0] if old else 0)
+            self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries until the store fits in max_bytes
+        if self._total <= self.max_bytes:
+            return
+        # The running total may have drifted; recount before deleting anything
+        self._total = self._count_bytes()
+        if self._total <= self.max_bytes:
+            return
+        for kind, key, size in self._db.execute(
+            "SELECT kind, key, size FROM entries ORDER BY last_access"
+        ).fetchall():
+            self._db.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (kind, key))
+            self._total -= size
+            if self._total <= self.max_bytes:
+                break
+
+    def cached_pages(self, pdf, extract):
+        # Extracted page text keyed by the PDF's content hash; extract(pdf) yields (page_number, text)
+        key = pdf_digest(pdf)
+        pages = self.get(PAGES, key)
+        if pages is not None:
+            yield from (tuple(page) for page in pages)
+            return
+        pages = []
+        for page in extract(pdf):
+            pages.append(page)
+            yield page
+        self.put(PAGES, key, pages)
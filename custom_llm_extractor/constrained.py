@@ -0,0 +1,182 @@
+import json
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList
+
+# Schema-constrained decoding. The output is forced to be exactly the compact JSON
+# object for the schema: braces, keys, colons and commas are emitted as fixed text and
+# the model only chooses the contents of each string value. Every generation therefore
+# parses, with the keys in the same shape as CRITERIA.
+MAX_VALUE_TOKENS = 64
+
+_vocab_cache = {}
+
+
+def schema_template(schema):
+    # Flatten a schema into alternating literal strings and value slots (None); each
+    # literal before a slot ends with the opening quote, the slot ends at the closing quote
+    parts = []
+    literal = []
+
+    def walk(node):
+        literal.append("{")
+        for i, (key, value) in enumerate(node.items()):
+            if i:
+                literal.append(",")
+            literal.append(json.dumps(key) + ":")
+            if isinstance(value, dict):
+                walk(value)
+            else:
+                literal.append('"')
+                parts.append("".join(literal))
+                literal.clear()
+                parts.append(None)
+        literal.append("}")
+
+    walk(schema)
+    parts.append("".join(literal))
+    return parts
+
+
+def _token_texts(tokenizer):
+    # The text each token adds to the output. Decoding a token on its own is not enough for
+    # SentencePiece tokenizers (Llama), which drop the leading space of "▁word" at the start
+    # of a string, so every token is decoded after an anchor token and the anchor cut off.
+    anchor = tokenizer("a", add_special_tokens=False)["input_ids"][-1]
+    prefix = tokenizer.decode([anchor])
+    texts = []
+    for i in range(len(tokenizer)):
+        text = tokenizer.decode([anchor, i])
+        texts.append(text[len(prefix):] if text.startswith(prefix) else tokenizer.decode([i]))
+    return texts
+
+
+def _vocab(tokenizer):
+    # Text of every token, which tokens may appear inside a JSON string value, the tokens
+    # starting with a quote, and every token grouped by first character, longest first
+    key = (tokenizer.name_or_path, len(tokenizer))
+    if key not in _vocab_cache:
+        texts = _token_texts(tokenizer)
+        special = set(tokenizer.all_special_ids)
+        safe = torch.tensor([
+            i not in special and bool(t) and '"' not in t and "\\" not in t and "�" not in t
+            and all(ch >= " " for ch in t)
+            for i, t in enumerate(texts)
+        ])
+        quoted = [(i, t) for i, t in enumerate(texts) if t.startswith('"') and i not in special]
+        by_first = {}
+        for i, t in enumerate(texts):
+            if t and i not in special:
+                by_first.setdefault(t[0], []).append((i, t))
+        for tokens in by_first.values():
+            tokens.sort(key=lambda token: -len(token[1]))
+        _vocab_cache[key] = (texts, safe, quoted, by_first)
+    return _vocab_cache[key]
+
+
+class _RowState:
+    def __init__(self, parts, value_cap):
+        self.parts = parts
+        self.value_cap = value_cap
+        self.reset()
+
+    def reset(self):
+        self.part = 0
+        self.offset = 0
+        self.value_tokens = 0
+        # Generated token ids advanced over so far
+        self.consumed = []
+
+    @property
+    def done(self):
+        return self.part >= len(self.parts)
+
+    def advance(self, text):
+        if not self.done and self.parts[self.part] is None:
+            self.value_tokens += 1
+        for ch in text:
+            if self.done:
+                break
+            part = self.parts[self.part]
+            if part is None:
+                if ch == '"':
+                    self.part += 1
+                    self.offset = 0
+                    self.value_tokens = 0
+            else:
+                self.offset += 1
+                if self.offset == len(part):
+                    self.part += 1
+                    self.offset = 0
+
+
+class SchemaJsonProcessor(LogitsProcessor):
+    def __init__(self, tokenizer, schemas, prompt_width, max_new_tokens, max_value_tokens=MAX_VALUE_TOKENS):
+        self.tokenizer = tokenizer
+        self.texts, self.safe, self.quoted, self._by_first = _vocab(tokenizer)
+        self.prompt_width = prompt_width
+        self._forced = {}
+        self._closing = {}
+        self.rows = []
+        for schema in schemas:
+            parts = schema_template(schema)
+            # Share what is left of max_new_tokens after the fixed text between the values,
+            # so the object is always closed before generation runs out
+            fixed = sum(len(self.tokenizer(p, add_special_tokens=False)["input_ids"]) for p in parts if p)
+            slots = parts.count(None)
+            value_cap = min(max_value_tokens, max(0, (max_new_tokens - fixed - slots) // max(slots, 1)))
+            self.rows.append(_RowState(parts, value_cap))
+
+    def _forced_token(self, literal):
+        # A token whose text starts the remaining fixed text: the first token of its canonical
+        # encoding when that fits (byte-level BPE), else the longest matching token, since
+        # SentencePiece encodes a standalone literal with a leading space ("▁{")
+        if literal not in self._forced:
+            token = self.tokenizer(literal, add_special_tokens=False)["input_ids"][0]
+            if not (self.texts[token] and literal.startswith(self.texts[token])):
+                token = next(i for i, t in self._by_first.get(literal[0], ()) if literal.startswith(t))
+            self._forced[literal] = token
+        return self._forced[literal]
+
+    def _closing_tokens(self, next_literal):
+        # Tokens that close the string value, optionally running on into the following fixed text
+        if next_literal not in self._closing:
+            self._closing[next_literal] = [i for i, t in self.quoted if next_literal.startswith(t[1:])]
+        return self._closing[next_literal]
+
+    def _allowed(self, row, vocab_size):
+        allowed = torch.zeros(vocab_size, dtype=torch.bool)
+        if row.done:
+            allowed[self.tokenizer.eos_token_id] = True
+            return allowed
+        part = row.parts[row.part]
+        if part is not None:
+            allowed[self._forced_token(part[row.offset:])] = True
+            return allowed
+        next_literal = row.parts[row.part + 1]
+        if row.value_tokens < row.value_cap:
+            n = min(vocab_size, len(self.safe))
+            allowed[:n] = self.safe[:n]
+        allowed[[i for i in self._closing_tokens(next_literal) if i < vocab_size]] = True
+        return allowed
+
+    def __call__(self, input_ids, scores):
+        # Assisted generation discards rejected draft tokens, and its draft model calls this
+        # same processor, so a row whose tokens no longer extend what it has advanced over
+        # is replayed from the start of the generated text
+        for row, tokens in zip(self.rows, input_ids[:, self.prompt_width:].tolist()):
+            if tokens[:len(row.consumed)] != row.consumed:
+                row.reset()
+            for token_id in tokens[len(row.consumed):]:
+                row.advance(self.texts[token_id] if token_id < len(self.texts) else "")
+            row.consumed = tokens
+        for i, row in enumerate(self.rows):
+            allowed = self._allowed(row, scores.shape[-1]).to(scores.device)
+            scores[i] = scores[i].masked_fill(~allowed, float("-inf"))
+        return scores
+
+
+def schema_logits_processor(tokenizer, schemas, prompt_width, max_new_tokens, max_value_tokens=MAX_VALUE_TOKENS):
+    return LogitsProcessorList([
+        SchemaJsonProcessor(tokenizer, schemas, prompt_width, max_new_tokens, max_value_tokens)
+    ])
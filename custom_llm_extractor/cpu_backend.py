@@ -0,0 +1,104 @@
+import copy
+import os
+import warnings
+
+import torch
+from transformers.pytorch_utils import Conv1D
+
+# CPU inference backends for the shared model loader:
+#   fp32 - stock weights
+#   int8 - dynamic int8 quantization of every Linear layer
+#   bf16 - bfloat16 weights, only where the CPU has native bf16 support
+# Any backend can additionally be wrapped with torch.compile (TENDER_LLM_COMPILE=1).
+BACKENDS = ("fp32", "int8", "bf16")
+DEFAULT_BACKEND = os.environ.get("TENDER_LLM_BACKEND", "fp32")
+DEFAULT_COMPILE = os.environ.get("TENDER_LLM_COMPILE") == "1"
+SELF_CHECK_PROMPT = 'Earnest Money Deposit of Rs. 5,00,000 shall be submitted. {"emd_submission": "'
+SELF_CHECK_TOLERANCE = 0.1
+
+
+def configure_threads(threads=None):
+    # Explicit intra-op thread count (defaults to TENDER_LLM_THREADS, else torch's choice)
+    threads = threads or int(os.environ.get("TENDER_LLM_THREADS", "0"))
+    if threads:
+        torch.set_num_threads(threads)
+    return torch.get_num_threads()
+
+
+def bf16_supported():
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def _conv1d_to_linear(model):
+    # GPT-2 style models use transformers' Conv1D (a transposed Linear), which dynamic
+    # quantization does not recognise; swap them for equivalent nn.Linear layers first
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                n_in, n_out = child.weight.shape
+                linear = torch.nn.Linear(n_in, n_out)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, child_name, linear)
+    return model
+
+
+def optimize_model(model, backend=DEFAULT_BACKEND, compile=DEFAULT_COMPILE):
+    # Returns the model and the backend actually applied, which is fp32 when bf16 is
+    # asked for on a CPU without native support
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}; expected one of {', '.join(BACKENDS)}")
+    model.eval()
+    if backend == "int8":
+        model = torch.ao.quantization.quantize_dynamic(_conv1d_to_linear(model), {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == "bf16":
+        if bf16_supported():
+            model = model.to(torch.bfloat16)
+        else:
+            warnings.warn("CPU has no native bf16 support; keeping fp32 weights")
+            backend = "fp32"
+    if compile:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model, backend
+
+
+def self_check(reference, candidate, tokenizer, tolerance=SELF_CHECK_TOLERANCE):
+    # Compare next-token distributions of the optimized model against the fp32 reference
+    # on a fixed probe; max_abs_diff is over softmax probabilities at every position
+    ids = tokenizer(SELF_CHECK_PROMPT, return_tensors="pt")["input_ids"]
+    with torch.inference_mode():
+        expected = torch.softmax(reference(ids).logits.float(), dim=-1)
+        actual = torch.softmax(candidate(ids).logits.float(), dim=-1)
+    max_abs_diff = (expected - actual).abs().max().item()
+    top1_agreement = (expected.argmax(-1) == actual.argmax(-1)).float().mean().item()
+    return {
+        "max_abs_diff": max_abs_diff,
+        "top1_agreement": top1_agreement,
+        "ok": max_abs_diff <= tolerance,
+    }
+
+
+def prepare_model(model, tokenizer, backend=DEFAULT_BACKEND, compile=DEFAULT_COMPILE, check=True):
+    # Optimize a freshly loaded fp32 model and return it with the backend in use and the
+    # self-check report (None when nothing was checked); if the self-check against the
+    # fp32 weights fails, fall back to fp32 rather than serve a model that drifted too far
+    if backend == "fp32" and not compile:
+        return model.eval(), "fp32", None
+    reference = copy.deepcopy(model).eval() if check else None
+    optimized, applied = optimize_model(model, backend, compile)
+    if reference is None or (applied == "fp32" and not compile):
+        # Unchanged fp32 weights (bf16 unsupported here) would pass the check trivially
+        return optimized, applied, None
+    report = self_check(reference, optimized, tokenizer)
+    if not report["ok"]:
+        warnings.warn(
+            f"{applied} backend failed the startup self-check "
+            f"(max prob diff {report['max_abs_diff']:.3f} > {SELF_CHECK_TOLERANCE}); using fp32"
+        )
+        return reference, "fp32", report
+    return optimized, applied, report
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import re
+import sys
+
+from cache import DOCUMENTS
+from keyword_index import heading_name, heading_paths
+from merging import ResultMerger
+
+# Incremental re-extraction for corrigenda, which re-publish a tender with a few pages
+# changed. Each page is fingerprinted by a hash of its normalized text and compared with
+# the version stored under the same document id. Chunks of the previous run whose pages
+# are all still present are reused as they are; only pages that changed, or that were
+# covered by a chunk touching a changed page, are chunked and generated again.
+_WHITESPACE = re.compile(r"\s+")
+
+
+def page_fingerprint(text):
+    # Insensitive to case and to whitespace/line-wrapping differences between PDF renderings
+    normalized = _WHITESPACE.sub(" ", text).strip().lower()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:32]
+
+
+def _runs(page_numbers):
+    # Group sorted page numbers into runs of consecutive pages
+    runs = []
+    for n in page_numbers:
+        if runs and n == runs[-1][-1] + 1:
+            runs[-1].append(n)
+        else:
+            runs.append([n])
+    return runs
+
+
+def _value_at(result, path):
+    for key in path:
+        if not isinstance(result, dict):
+            return None
+        result = result.get(key)
+    return result
+
+
+def changed_fields(previous, current, criteria):
+    # Dotted heading names whose merged value differs between two criteria-shaped results
+    return [
+        heading_name(path)
+        for path, _ in heading_paths(criteria)
+        if _value_at(previous, path) != _value_at(current, path)
+    ]
+
+
+def run_incremental_extraction(document_id, pages, nlp, criteria, build_prompt, cache, **options):
+    # pages is an iterable of (page_number, text), or an extract_text.PageStore whose pages are
+    # read back as they are re-chunked; options are passed to run_batch_extraction.
+    # Returns the usual {"result", "provenance", "chunks"} plus "changed_pages" (page numbers that had to
+    # be re-inferred), "reused_chunks", "changed_fields" and "previous_version" (whether a
+    # stored version was found). The new version replaces the stored one.
+    # Imported here so that running this file as a script (whose spawned PDF parsing
+    # workers re-import it) does not load torch in every worker
+    from model_registry import model_id
+    from tender_pipeline import run_batch_extraction
+
+    if not hasattr(pages, "__getitem__"):
+        pages = list(pages)
+    fingerprints = {}
+    positions = {}
+    for i, (number, text) in enumerate(pages):
+        fingerprints[number] = page_fingerprint(text)
+        positions[number] = i
+    # Outputs are only reusable if they came from the same model and prompt/decoding setup
+    setup = [model_id(nlp), options.get("prompt_builder") is not None, bool(options.get("constrained")),
+             options.get("rules") is not None, options.get("retriever") is not None]
+    previous = cache.get(DOCUMENTS, document_id)
+    if previous is not None and previous.get("setup") != setup:
+        previous = None
+
+    kept, dropped = [], set()
+    if previous is None:
+        redo = [number for number, _ in pages]
+    else:
+        present = set(fingerprints.values())
+        for chunk in previous["chunks"]:
+            if all(fp in present for fp in chunk["pages"]):
+                kept.append(chunk)
+            else:
+                dropped.update(chunk["pages"])
+        old_pages = set(previous["pages"])
+        redo = [number for number, fp in fingerprints.items() if fp not in old_pages or fp in dropped]
+
+    runs = [(pages[positions[n]] for n in run) for run in _runs(sorted(redo))]
+    extractions = run_batch_extraction(runs, nlp, criteria, build_prompt, cache=cache, **options) if runs else []
+
+    first_page = {}
+    for number, fp in fingerprints.items():
+        first_page.setdefault(fp, number)
+    chunks = [
+        dict(c, pages=[first_page[fp] for fp in c["pages"]], cached=True, reused=True)
+        for c in kept
+    ]
+    for extraction in extractions:
+        chunks.extend(dict(c, reused=False) for c in extraction["chunks"])
+    chunks.sort(key=lambda c: min(c["pages"], default=0))
+    merger = ResultMerger(criteria)
+    for index, chunk in enumerate(chunks):
+        chunk["chunk"] = index
+        merger.add_chunk(chunk)
+    result = merger.result()
+
+    stored_chunks = [
+        {
+            "pages": [fingerprints[n] for n in c["pages"] if n in fingerprints],
+            "headings": c.get("headings"),
+            "output": c["output"],
+            "parsed": c["parsed"],
+            "rule_findings": c.get("rule_findings") or {},
+        }
+        for c in chunks
+    ]
+    cache.put(DOCUMENTS, document_id, {
+        "setup": setup,
+        "pages": list(fingerprints.values()),
+        "chunks": stored_chunks,
+        "result": result,
+    })
+    return {
+        "result": result,
+        "provenance": merger.provenance(),
+        "chunks": chunks,
+        "changed_pages": sorted(redo),
+        "reused_chunks": len(kept),
+        "changed_fields": changed_fields(previous["result"], result, criteria) if previous else [],
+        "previous_version": previous is not None,
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python incremental.py <pdf_path> <document_id>")
+        sys.exit(1)
+    from cache import ResultCache
+    from extract_text import iter_pdf_pages_parallel
+    from infer_llm import CRITERIA, KEYWORD_INDEX, RULES, build_prompt
+    from model_registry import get_pipeline
+    from prefix_cache import PrefixCache
+    from prompts import PromptBuilder
+
+    nlp = get_pipeline()
+    cache = ResultCache()
+    extraction = run_incremental_extraction(
+        sys.argv[2], cache.cached_pages(sys.argv[1], iter_pdf_pages_parallel), nlp, CRITERIA, build_prompt, cache,
+        keyword_index=KEYWORD_INDEX, prompt_builder=PromptBuilder(nlp.tokenizer, CRITERIA), constrained=True,
+        prefix_cache=PrefixCache(), rules=RULES,
+    )
+    print(json.dumps({k: extraction[k] for k in ("result", "changed_pages", "reused_chunks", "changed_fields")},
+                     indent=2))
@@ -1,6 +1,13 @@
 import sys
 import json
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from cache import ResultCache
+from extract_text import PageStore, iter_pdf_pages, iter_pdf_pages_parallel, prefetch
+from keyword_index import KeywordIndex
+from prompts import PromptBuilder
+from rules import RuleExtractor
+
+# torch/transformers are imported in main(), not at import time: the PDF parsing workers
+# are spawned processes that re-import the main script, and should only need extract_text
 
 # Example criteria (replace with your full schema as needed)
 CRITERIA = {
@@ -133,6 +140,9 @@ CRITERIA = {
     }
 }
 
+KEYWORD_INDEX = KeywordIndex(CRITERIA)
+RULES = RuleExtractor(CRITERIA)
+
 def build_prompt(text, criteria):
     return f"""
 You are an expert tender document analyst. Given the following text chunk from a tender document, extract all information relevant to the following criteria, grouping your findings under each heading. If nothing is found for a heading, write "Not found".
@@ -150,21 +160,33 @@ Respond in JSON format matching the criteria structure.
 
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python infer_llm.py <text_file>")
+        print("Usage: python infer_llm.py <text_file | pdf_file>")
         sys.exit(1)
-    text_file = sys.argv[1]
-    with open(text_file, "r", encoding="utf-8") as f:
-        text = f.read()
+    input_file = sys.argv[1]
+    from model_registry import DRAFT_MODEL, get_pipeline
+    from prefix_cache import PrefixCache
+    from tender_pipeline import MEMORY_BUDGET_MB, run_extraction
 
     # Use a lightweight model (change model_name as needed)
     model_name = "distilgpt2"  # Or "TinyLlama/TinyLlama-1.1B-Chat-v1.0", etc.
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForCausalLM.from_pretrained(model_name)
-    nlp = pipeline("text-generation", model=model, tokenizer=tokenizer)
+    nlp = get_pipeline(model_name, draft=DRAFT_MODEL)
+    prompt_builder = PromptBuilder(nlp.tokenizer, CRITERIA)
+    cache = ResultCache()
+
+    if input_file.lower().endswith(".pdf") and MEMORY_BUDGET_MB:
+        # Low-memory mode: pages are spilled to disk and read back one chunk window at a time
+        document = PageStore(iter_pdf_pages(input_file))
+    elif input_file.lower().endswith(".pdf"):
+        # Pages are parsed in the background while earlier chunks are generating
+        document = prefetch(cache.cached_pages(input_file, iter_pdf_pages_parallel))
+    else:
+        with open(input_file, "r", encoding="utf-8") as f:
+            document = f.read()
 
-    prompt = build_prompt(text, CRITERIA)
-    response = nlp(prompt, max_new_tokens=1024)[0]['generated_text']
-    print(response)
+    extraction = run_extraction(document, nlp, CRITERIA, build_prompt, keyword_index=KEYWORD_INDEX,
+                                prompt_builder=prompt_builder, cache=cache, constrained=True,
+                                prefix_cache=PrefixCache(), rules=RULES, memory_budget=MEMORY_BUDGET_MB * 2**20)
+    print(json.dumps(extraction["result"], indent=2))
 
 if __name__ == "__main__":
     main()
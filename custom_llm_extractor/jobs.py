@@ -0,0 +1,238 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Background extraction jobs for documents too long to wait on. A job is recorded in a
+# local SQLite file (request options, the uploaded document, progress, the partial merged
+# result after every chunk, the final result or error) before it is queued, so a client
+# can poll it from any process. Each job is tagged with the kind of runner that can run it
+# (the Streamlit app and the handler expect different requests), and a running job records
+# its owner process, which refreshes a heartbeat while it is alive. A JobQueue opening the
+# file only takes over running jobs of its kind whose owner has exited or stopped beating,
+# so a restart resumes interrupted jobs without stealing live ones. Generated chunks are in
+# the result cache, so a resumed job only regenerates the chunks that had not finished.
+DEFAULT_JOBS_PATH = os.path.join(os.path.expanduser("~"), ".cache", "tender_llm", "jobs.sqlite")
+JOB_WORKERS = int(os.environ.get("TENDER_LLM_JOB_WORKERS", "1"))
+HEARTBEAT_SECONDS = 10
+# A running job whose heartbeat is older than this is taken to be orphaned
+STALE_SECONDS = 6 * HEARTBEAT_SECONDS
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+_JSON_FIELDS = ("request", "progress", "partial", "result")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# Random per process: after a container restart the new process often has the same
+# hostname and PID as the one that left jobs running, and must not mistake them for its own
+_PROCESS_TOKEN = uuid.uuid4().hex
+
+
+def process_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{_PROCESS_TOKEN}"
+
+
+def _owner_alive(owner):
+    # Only processes on this host can be checked directly; elsewhere the heartbeat decides
+    host, pid, token = ((owner or "").rsplit(":", 2) + ["", ""])[:3]
+    if host != socket.gethostname():
+        return True
+    if pid == str(os.getpid()):
+        # Our PID: alive only if it is this very process, not an earlier one that had it
+        return token == _PROCESS_TOKEN
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+
+class JobStore:
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("TENDER_LLM_JOBS", DEFAULT_JOBS_PATH)
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, request TEXT NOT NULL, document BLOB, "
+                "progress TEXT, partial TEXT, result TEXT, error TEXT, cancel INTEGER NOT NULL DEFAULT 0, "
+                "created REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            # Files written before jobs had kinds and owners
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+            for name, definition in (("kind", "TEXT NOT NULL DEFAULT ''"), ("owner", "TEXT"), ("heartbeat", "REAL")):
+                if name not in columns:
+                    self._db.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+
+    def create(self, request, document=None, kind=""):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO jobs (id, kind, status, request, document, progress, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, QUEUED, json.dumps(request), document, json.dumps({}), now, now),
+            )
+        return job_id
+
+    def get(self, job_id, with_document=False):
+        columns = "id, kind, status, request, progress, partial, result, error, owner, created, updated"
+        if with_document:
+            columns += ", document"
+        with self._lock:
+            cursor = self._db.execute(f"SELECT {columns} FROM jobs WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+            names = [d[0] for d in cursor.description]
+        if row is None:
+            return None
+        job = dict(zip(names, row))
+        for field in _JSON_FIELDS:
+            if job[field] is not None:
+                job[field] = json.loads(job[field])
+        return job
+
+    def update(self, job_id, owner, **fields):
+        # Only while owner is running the job, so a job taken over by another process, or
+        # already given a final status, is not overwritten; returns whether it was updated
+        for field in _JSON_FIELDS:
+            if field in fields:
+                fields[field] = json.dumps(fields[field])
+        fields["updated"] = fields["heartbeat"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ? AND status = ? AND owner = ?",
+                (*fields.values(), job_id, RUNNING, owner),
+            )
+            return cursor.rowcount > 0
+
+    def cancel(self, job_id):
+        # A queued job is cancelled at once, a running one when it reports its next chunk;
+        # returns False for unknown or already finished jobs
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                f"UPDATE jobs SET cancel = 1, updated = ?, status = CASE status WHEN ? THEN ? ELSE status END "
+                f"WHERE id = ? AND status NOT IN ({', '.join('?' * len(FINISHED))})",
+                (time.time(), QUEUED, CANCELLED, job_id, *FINISHED),
+            )
+            return cursor.rowcount > 0
+
+    def start(self, job_id, owner):
+        # Move a queued job to running under owner; False if it was cancelled (or taken) meanwhile
+        now = time.time()
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "UPDATE jobs SET status = ?, owner = ?, heartbeat = ?, updated = ? WHERE id = ? AND status = ?",
+                (RUNNING, owner, now, now, job_id, QUEUED),
+            )
+            return cursor.rowcount > 0
+
+    def beat(self, owner):
+        # Refresh the heartbeat of every job owner is running
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = ?", (time.time(), owner, RUNNING)
+            )
+
+    def reclaim(self, job_id, owner, heartbeat):
+        # Queue an orphaned running job again, unless its owner (or heartbeat) changed meanwhile
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, updated = ? "
+                "WHERE id = ? AND status = ? AND owner IS ? AND heartbeat IS ?",
+                (QUEUED, time.time(), job_id, RUNNING, owner, heartbeat),
+            )
+            return cursor.rowcount > 0
+
+    def cancel_requested(self, job_id):
+        with self._lock:
+            row = self._db.execute("SELECT cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def unfinished(self, kind=""):
+        # (id, status, owner, heartbeat) of the queued and running jobs of a kind
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, status, owner, heartbeat FROM jobs WHERE kind = ? AND status IN (?, ?) ORDER BY created",
+                (kind, QUEUED, RUNNING),
+            ).fetchall()
+
+
+class JobQueue:
+    # runner(request, document, report) does the extraction and returns a JSON-able result;
+    # it calls report(progress, partial) after each chunk, which raises JobCancelled once
+    # the job has been cancelled. At most `workers` jobs run at a time. kind names the
+    # runner: only jobs submitted with the same kind are run (or resumed) by this queue.
+    def __init__(self, runner, store=None, workers=JOB_WORKERS, kind=""):
+        self.runner = runner
+        self.kind = kind
+        self.store = store or JobStore()
+        self.owner = process_owner()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._closed = threading.Event()
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+        stale = time.time() - STALE_SECONDS
+        for job_id, status, owner, heartbeat in self.store.unfinished(kind):
+            if status == RUNNING:
+                if _owner_alive(owner) and (heartbeat or 0) > stale:
+                    continue
+                if not self.store.reclaim(job_id, owner, heartbeat):
+                    continue
+            # A queued job may also be in its submitter's queue; only one start() succeeds
+            self._executor.submit(self._run, job_id)
+
+    def _heartbeat(self):
+        while not self._closed.wait(HEARTBEAT_SECONDS):
+            self.store.beat(self.owner)
+
+    def submit(self, request, document=None):
+        job_id = self.store.create(request, document, self.kind)
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def status(self, job_id):
+        return self.store.get(job_id)
+
+    def cancel(self, job_id):
+        return self.store.cancel(job_id)
+
+    def _run(self, job_id):
+        if not self.store.start(job_id, self.owner):
+            return
+        job = self.store.get(job_id, with_document=True)
+
+        def report(progress, partial=None):
+            # Stop as if cancelled if another process has taken the job over
+            if self.store.cancel_requested(job_id) or not self.store.update(
+                job_id, self.owner, progress=progress, partial=partial
+            ):
+                raise JobCancelled(job_id)
+
+        try:
+            self.store.update(job_id, self.owner, status=DONE,
+                              result=self.runner(job["request"], job["document"], report))
+        except JobCancelled:
+            self.store.update(job_id, self.owner, status=CANCELLED)
+        except Exception as e:
+            self.store.update(job_id, self.owner, status=FAILED, error=f"{type(e).__name__}: {e}")
+
+    def close(self, wait=True):
+        self._closed.set()
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,90 @@
+import re
+from bisect import bisect_right
+
+PASSAGE_BREAK = re.compile(r"\f|\n[ \t]*\n")
+MAX_PASSAGE_CHARS = 1500
+
+
+def heading_paths(criteria, parent=()):
+    # Yield (path, keywords) for every leaf heading, e.g. (("specific_criteria", "turnover"), [...])
+    for key, value in criteria.items():
+        if isinstance(value, dict):
+            yield from heading_paths(value, parent + (key,))
+        else:
+            yield parent + (key,), value
+
+
+def heading_name(path):
+    return ".".join(path)
+
+
+class KeywordIndex:
+    # One compiled alternation over every CRITERIA keyword, so a document is scanned
+    # in a single pass no matter how many headings or keywords there are
+
+    def __init__(self, criteria):
+        self.headings = {}
+        for path, keywords in heading_paths(criteria):
+            for keyword in keywords:
+                keyword = " ".join(keyword.lower().split())
+                if keyword:
+                    self.headings.setdefault(keyword, set()).add(heading_name(path))
+
+        # The regex stops at the longest keyword at each position, so a longer
+        # keyword also carries the headings of any keyword it contains
+        for keyword, names in self.headings.items():
+            for other, other_names in self.headings.items():
+                if other != keyword and re.search(rf"(?<!\w){re.escape(other)}(?!\w)", keyword):
+                    names |= other_names
+
+        alternatives = sorted(self.headings, key=len, reverse=True)
+        self.pattern = re.compile(
+            r"(?<!\w)(?:"
+            + "|".join(r"\s+".join(map(re.escape, k.split())) for k in alternatives)
+            + r")(?!\w)",
+            re.IGNORECASE,
+        )
+
+    def _names(self, match):
+        return self.headings[" ".join(match.group(0).lower().split())]
+
+    def headings_in(self, text):
+        names = set()
+        for match in self.pattern.finditer(text):
+            names |= self._names(match)
+        return names
+
+    def passages(self, text, max_chars=MAX_PASSAGE_CHARS):
+        # Split text into paragraph-sized passages and return only those that mention
+        # a criteria keyword, in document order, each annotated with the headings it hits
+        bounds = passage_bounds(text, max_chars)
+        starts = [start for start, _ in bounds]
+        hits = {}
+        for match in self.pattern.finditer(text):
+            i = bisect_right(starts, match.start()) - 1
+            hits.setdefault(i, set()).update(self._names(match))
+        return [
+            {"start": bounds[i][0], "text": text[bounds[i][0]:bounds[i][1]].strip(), "headings": sorted(hits[i])}
+            for i in sorted(hits)
+        ]
+
+    def filter_text(self, text, max_chars=MAX_PASSAGE_CHARS):
+        return "\n\n".join(p["text"] for p in self.passages(text, max_chars))
+
+
+def passage_bounds(text, max_chars):
+    # Paragraph boundaries first; paragraphs longer than max_chars are cut at line breaks
+    bounds = []
+    start = 0
+    breaks = [m.end() for m in PASSAGE_BREAK.finditer(text)] + [len(text)]
+    for end in breaks:
+        while end - start > max_chars:
+            cut = text.rfind("\n", start + 1, start + max_chars)
+            if cut == -1:
+                cut = start + max_chars
+            bounds.append((start, cut))
+            start = cut
+        if end > start:
+            bounds.append((start, end))
+            start = end
+    return bounds
@@ -0,0 +1,230 @@
+import os
+import platform
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Per-request stage timings and counters, plus a process-wide aggregate rendered in the
+# Prometheus text exposition format. Stage times are exclusive: while a nested stage runs
+# (e.g. PDF parsing pulled lazily from inside chunking) the enclosing stage is paused, so
+# the stages of one request add up to at most its wall time. Inside sampling_rss(),
+# resident memory is also sampled in the background and its peak charged to whichever
+# stages are running, for sizing containers. Only the standard library is used, so importing this
+# module does not pull in torch.
+STAGES = ("pdf_parse", "keyword_filter", "retrieval", "rules", "chunking", "tokenize", "prefill", "decode", "json_parse")
+METRICS_FILE = os.environ.get("TENDER_LLM_METRICS_FILE")
+RSS_SAMPLE_SECONDS = 0.005
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # ru_maxrss is the lifetime peak (KiB on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if platform.system() == "Darwin" else peak * 1024
+
+
+class PeakRss:
+    # Samples resident memory on a background thread while the block runs
+    def __enter__(self):
+        self.peak = rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(RSS_SAMPLE_SECONDS):
+            self.peak = max(self.peak, rss_bytes())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.peak_rss = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Every thread's stage stack, so the RSS sampler can see which stages are running,
+        # plus stages timed with add_time (prefill, decode) while they run
+        self._stacks = {}
+        self._running = {}
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.seconds[stage] += seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def running(self, key, stage):
+        # Mark stage as running under key (None when it ends) for RSS sampling
+        with self._lock:
+            if stage is None:
+                self._running.pop(key, None)
+            else:
+                self._running[key] = stage
+
+    def sample_rss(self):
+        rss = rss_bytes()
+        with self._lock:
+            stages = set(self._running.values())
+            for stack in self._stacks.values():
+                try:
+                    stages.add(stack[-1][0])
+                except IndexError:
+                    continue
+            for stage in stages:
+                self.peak_rss[stage] = max(self.peak_rss.get(stage, 0), rss)
+
+    @contextmanager
+    def sampling_rss(self, enabled=True):
+        # Polls resident memory on a background thread while the block runs; the thread
+        # is stopped and joined on exit, so idle Metrics objects cost nothing
+        if not enabled:
+            yield self
+            return
+        stop = threading.Event()
+
+        def sample():
+            while not stop.wait(RSS_SAMPLE_SECONDS):
+                self.sample_rss()
+
+        thread = threading.Thread(target=sample, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+            self.sample_rss()
+
+    @contextmanager
+    def timer(self, stage):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+            with self._lock:
+                self._stacks[threading.get_ident()] = self._local.stack
+        stack = self._local.stack
+        now = time.perf_counter()
+        if stack:
+            self.add_time(stack[-1][0], now - stack[-1][1])
+        stack.append([stage, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            stage, start = stack.pop()
+            self.add_time(stage, now - start)
+            if stack:
+                stack[-1][1] = now
+
+    def timed(self, iterable, stage):
+        # Charge the time spent producing each item of a lazy iterable to stage
+        iterator = iter(iterable)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def as_dict(self):
+        with self._lock:
+            report = {
+                "total_seconds": round(time.perf_counter() - self.started, 4),
+                "seconds": {stage: round(s, 4) for stage, s in self.seconds.items()},
+                "counts": dict(self.counts),
+            }
+            if self.peak_rss:
+                report["peak_rss_mb"] = {stage: round(rss / 2**20, 1) for stage, rss in self.peak_rss.items()}
+        # Assisted generation: share of draft-model tokens the target model accepted
+        if report["counts"].get("draft_tokens"):
+            report["draft_acceptance_rate"] = round(
+                report["counts"].get("accepted_draft_tokens", 0) / report["counts"]["draft_tokens"], 3
+            )
+        return report
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.peak_rss = defaultdict(int)
+
+    def record(self, metrics):
+        snapshot = metrics.as_dict()
+        with self._lock:
+            self.requests += 1
+            self.request_seconds += snapshot["total_seconds"]
+            for stage, seconds in snapshot["seconds"].items():
+                self.seconds[stage] += seconds
+            for name, n in snapshot["counts"].items():
+                self.counts[name] += n
+            for stage, rss in metrics.peak_rss.items():
+                self.peak_rss[stage] = max(self.peak_rss[stage], rss)
+
+    def prometheus_text(self, caches=None):
+        # caches maps a label to a ResultCache or PrefixCache whose hits/misses are
+        # cumulative counters (a dict per kind for ResultCache)
+        with self._lock:
+            lines = [
+                "# HELP tender_llm_requests_total Extraction requests served.",
+                "# TYPE tender_llm_requests_total counter",
+                f"tender_llm_requests_total {self.requests}",
+                "# HELP tender_llm_request_seconds_total Wall time spent in extraction requests.",
+                "# TYPE tender_llm_request_seconds_total counter",
+                f"tender_llm_request_seconds_total {self.request_seconds:.6f}",
+                "# HELP tender_llm_stage_seconds_total Time spent in each pipeline stage.",
+                "# TYPE tender_llm_stage_seconds_total counter",
+            ]
+            for stage in sorted(set(STAGES) | set(self.seconds)):
+                lines.append(f'tender_llm_stage_seconds_total{{stage="{stage}"}} {self.seconds.get(stage, 0.0):.6f}')
+            if self.peak_rss:
+                lines.append("# HELP tender_llm_stage_peak_rss_bytes Highest resident memory seen while each stage ran.")
+                lines.append("# TYPE tender_llm_stage_peak_rss_bytes gauge")
+                for stage in sorted(self.peak_rss):
+                    lines.append(f'tender_llm_stage_peak_rss_bytes{{stage="{stage}"}} {self.peak_rss[stage]}')
+            for name in sorted(self.counts):
+                lines.append(f"# TYPE tender_llm_{name}_total counter")
+                lines.append(f"tender_llm_{name}_total {self.counts[name]}")
+            if self.counts.get("draft_tokens"):
+                lines.append("# HELP tender_llm_draft_acceptance_ratio Share of drafted tokens accepted by the target model.")
+                lines.append("# TYPE tender_llm_draft_acceptance_ratio gauge")
+                ratio = self.counts.get("accepted_draft_tokens", 0) / self.counts["draft_tokens"]
+                lines.append(f"tender_llm_draft_acceptance_ratio {ratio:.6f}")
+        if caches:
+            for series in ("hits", "misses"):
+                lines.append(f"# TYPE tender_llm_cache_{series}_total counter")
+                for cache_name, cache in caches.items():
+                    values = getattr(cache, series)
+                    if not isinstance(values, dict):
+                        values = {cache_name: values}
+                    for kind, value in values.items():
+                        lines.append(f'tender_llm_cache_{series}_total{{cache="{cache_name}",kind="{kind}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, caches=None):
+        # Atomic replace so a scraper (e.g. node_exporter's textfile collector) never reads a partial file
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text(caches))
+        os.replace(tmp, path)
+
+
+METRICS = MetricsRegistry()
@@ -0,0 +1,183 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from keyword_index import MAX_PASSAGE_CHARS, heading_name, heading_paths, passage_bounds
+from model_registry import model_id
+from tender_pipeline import prepare_batching
+
+# Embedding-based routing of criteria headings to passages. Keyword matching misses
+# paraphrases ("bidder's average yearly revenue") and cannot rank, so instead every
+# paragraph-sized passage is embedded with the loaded model's own hidden states (masked
+# mean of the last layer) and each heading gets a query vector built from its name and
+# CRITERIA keywords. Only the top_k passages per heading are sent to the model, so the
+# number of generation calls per document stays bounded however many pages it has.
+# Passage matrices are saved as .npy files keyed by model and text and memory-mapped back.
+DEFAULT_EMBEDDING_DIR = os.path.join(os.path.expanduser("~"), ".cache", "tender_llm", "embeddings")
+TOP_K = 3
+EMBED_BATCH_SIZE = 16
+EMBED_MAX_TOKENS = 256
+# Passages are recognised inside chunk text by their first and last characters
+MARKER_CHARS = 64
+
+
+def embed_texts(nlp, texts, batch_size=EMBED_BATCH_SIZE, max_tokens=EMBED_MAX_TOKENS):
+    # float32 matrix with one row per text: masked mean of the model's last hidden layer
+    import torch
+
+    tokenizer, model = nlp.tokenizer, nlp.model
+    prepare_batching(tokenizer, model)
+    rows = []
+    for i in range(0, len(texts), batch_size):
+        encoded = tokenizer(texts[i:i + batch_size], return_tensors="pt", padding=True, truncation=True,
+                            max_length=max_tokens)
+        mask = encoded["attention_mask"].to(model.device)
+        # Left padding: count positions from each row's first real token
+        position_ids = (mask.cumsum(-1) - 1).clamp(min=0)
+        with torch.inference_mode():
+            output = model(input_ids=encoded["input_ids"].to(model.device), attention_mask=mask,
+                           position_ids=position_ids, output_hidden_states=True)
+        hidden = output.hidden_states[-1]
+        weights = mask.unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * weights).sum(1) / weights.sum(1).clamp(min=1)
+        rows.append(pooled.float().cpu().numpy())
+    if not rows:
+        return np.zeros((0, model.config.hidden_size), dtype=np.float32)
+    return np.concatenate(rows)
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def top_k(scores, k):
+    # Row indices of the k highest scores in each column of a (passages x headings) matrix,
+    # best first; a (k x headings) array
+    k = min(k, scores.shape[0])
+    if k == 0:
+        return np.zeros((0, scores.shape[1]), dtype=np.int64)
+    best = np.argpartition(-scores, k - 1, axis=0)[:k]
+    order = np.argsort(-np.take_along_axis(scores, best, axis=0), axis=0)
+    return np.take_along_axis(best, order, axis=0)
+
+
+class EmbeddingStore:
+    # Directory of .npy matrices, written atomically and read back memory-mapped
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("TENDER_LLM_EMBEDDINGS", DEFAULT_EMBEDDING_DIR)
+        os.makedirs(self.path, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.npy")
+
+    def get(self, key):
+        try:
+            matrix = np.load(self._file(key), mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return matrix
+
+    def put(self, key, matrix):
+        tmp = f"{self._file(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, np.ascontiguousarray(matrix, dtype=np.float32))
+        os.replace(tmp, self._file(key))
+
+
+def embedding_key(model_name, texts):
+    digest = hashlib.sha256(model_name.encode("utf-8"))
+    for text in texts:
+        digest.update(b"\x00" + text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class PassageRouter:
+    # Stands in for the KeywordIndex when chunking retrieved passages: a chunk is routed
+    # the headings that selected any passage in it, plus its keyword hits if there is an index
+    def __init__(self, passages, headings, keyword_index=None):
+        self._markers = [(text[:MARKER_CHARS], text[-MARKER_CHARS:], names) for text, names in zip(passages, headings)]
+        self.keyword_index = keyword_index
+
+    def headings_in(self, text):
+        names = set()
+        for head, tail, passage_headings in self._markers:
+            if head in text or tail in text:
+                names |= passage_headings
+        if self.keyword_index is not None:
+            names |= self.keyword_index.headings_in(text)
+        return names
+
+
+class Retriever:
+    def __init__(self, criteria, top_k=TOP_K, store=None):
+        self.top_k = top_k
+        self.store = store
+        self.headings = []
+        self.queries = []
+        for path, keywords in heading_paths(criteria):
+            self.headings.append(heading_name(path))
+            self.queries.append(f"{path[-1].replace('_', ' ')}: {', '.join(keywords)}")
+        self._query_vectors = {}
+        self._lock = threading.Lock()
+
+    def _vectors(self, nlp, texts):
+        if self.store is None:
+            return embed_texts(nlp, texts)
+        key = embedding_key(model_id(nlp), texts)
+        vectors = self.store.get(key)
+        if vectors is None:
+            vectors = embed_texts(nlp, texts)
+            self.store.put(key, vectors)
+        return vectors
+
+    def query_vectors(self, nlp):
+        # One row per heading, computed once per model
+        name = model_id(nlp)
+        with self._lock:
+            if name not in self._query_vectors:
+                self._query_vectors[name] = self._vectors(nlp, self.queries)
+            return self._query_vectors[name]
+
+    def route(self, nlp, pages, keyword_index=None, metrics=None):
+        # Returns (pages, router): pages reduced to the passages some heading ranked in its
+        # top_k, in document order, and a PassageRouter to use as the chunker's keyword_index
+        passages = []
+        for number, text in pages:
+            for start, end in passage_bounds(text, MAX_PASSAGE_CHARS):
+                passage = text[start:end].strip()
+                if passage:
+                    passages.append((number, passage))
+        if not passages:
+            return [], PassageRouter([], [], keyword_index)
+        vectors = self._vectors(nlp, [text for _, text in passages])
+        queries = self.query_vectors(nlp)
+        # Decoder hidden states share a large common component; centring on the document's
+        # mean passage leaves the directions that tell its passages apart
+        center = vectors.mean(axis=0)
+        scores = _normalize(vectors - center) @ _normalize(queries - center).T
+        chosen = {}
+        for heading, rows in zip(self.headings, top_k(scores, self.top_k).T):
+            for row in rows:
+                chosen.setdefault(int(row), set()).add(heading)
+        if metrics is not None:
+            metrics.count("passages", len(passages))
+            metrics.count("retrieved_passages", len(chosen))
+
+        selected, texts, headings = [], [], []
+        for row in sorted(chosen):
+            number, text = passages[row]
+            if selected and selected[-1][0] == number:
+                selected[-1][1].append(text)
+            else:
+                selected.append((number, [text]))
+            texts.append(text)
+            headings.append(chosen[row])
+        pages = [(number, "\n\n".join(page_passages)) for number, page_passages in selected]
+        return pages, PassageRouter(texts, headings, keyword_index)
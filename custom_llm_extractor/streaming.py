@@ -0,0 +1,140 @@
+import threading
+import time
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+from constrained import schema_logits_processor
+from speculative import DraftCounter, assisted_kwargs, record_acceptance
+
+
+class JsonBraceTracker:
+    # Incremental scanner that reports when the first top-level JSON object is closed;
+    # braces inside string literals are ignored
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.done = False
+
+    def feed(self, text):
+        for ch in text:
+            if self.done:
+                break
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = self.depth > 0
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}" and self.depth > 0:
+                self.depth -= 1
+                self.done = self.depth == 0
+        return self.done
+
+
+class JsonObjectStop(StoppingCriteria):
+    # Stops each sequence as soon as its generated text contains a complete JSON object,
+    # instead of decoding until max_new_tokens
+    def __init__(self, tokenizer, prompt_width):
+        self.tokenizer = tokenizer
+        self.seen = prompt_width
+        self.trackers = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.trackers is None:
+            self.trackers = [JsonBraceTracker() for _ in range(input_ids.shape[0])]
+        new_tokens = input_ids[:, self.seen:]
+        self.seen = input_ids.shape[1]
+        for tracker, row in zip(self.trackers, new_tokens):
+            if not tracker.done:
+                tracker.feed(self.tokenizer.decode(row, skip_special_tokens=True))
+        return torch.tensor([t.done for t in self.trackers], dtype=torch.bool, device=input_ids.device)
+
+
+class GenerationTimer(StoppingCriteria):
+    # Never stops generation; records when the first new token is ready (prefill) and
+    # how long the remaining decode steps took
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = time.perf_counter()
+        self.first = None
+        self.steps = 0
+        metrics.running(self, "prefill")
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first is None:
+            self.first = time.perf_counter()
+            self.metrics.running(self, "decode")
+        self.steps += 1
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    def finish(self):
+        end = time.perf_counter()
+        first = self.first or end
+        self.metrics.running(self, None)
+        self.metrics.add_time("prefill", first - self.start)
+        self.metrics.add_time("decode", end - first)
+
+
+def json_stopping_criteria(tokenizer, prompt_width):
+    return StoppingCriteriaList([JsonObjectStop(tokenizer, prompt_width)])
+
+
+def stream_generate(nlp, input_ids, max_new_tokens, schema=None, prefix_len=0, prefix_cache=None, metrics=None):
+    # Yield generated text pieces for one prompt as they are decoded; generation runs in a
+    # background thread and stops once the JSON object closes. With a schema, decoding is
+    # constrained to the compact JSON object for it; with a prefix_cache, generation resumes
+    # from the cached past_key_values of the first prefix_len ids, unless the pipeline has a
+    # draft model for assisted generation. With metrics, prefill and decode time, the
+    # generated token count and (when assisted) draft acceptance are recorded.
+    model = nlp.model
+    draft = getattr(nlp, "draft_model", None)
+    tokenizer = nlp.tokenizer
+    ids = torch.tensor([list(input_ids)], device=model.device)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    stopping_criteria = json_stopping_criteria(tokenizer, ids.shape[1])
+    timer = GenerationTimer(metrics) if metrics is not None else None
+    if timer is not None:
+        stopping_criteria.append(timer)
+    kwargs = dict(
+        input_ids=ids,
+        attention_mask=torch.ones_like(ids),
+        max_new_tokens=max_new_tokens,
+        pad_token_id=pad_id,
+        streamer=streamer,
+        stopping_criteria=stopping_criteria,
+        logits_processor=schema_logits_processor(tokenizer, [schema], ids.shape[1], max_new_tokens) if schema else None,
+        **assisted_kwargs(nlp),
+    )
+    errors = []
+
+    def run():
+        try:
+            with torch.inference_mode(), DraftCounter(draft) as drafts:
+                if prefix_cache is not None and prefix_len and draft is None:
+                    kwargs["past_key_values"] = prefix_cache.past_for_batch(nlp, input_ids[:prefix_len], 1)
+                output = model.generate(**kwargs)
+            if timer is not None:
+                timer.finish()
+                generated = output.shape[1] - ids.shape[1]
+                metrics.count("generated_tokens", generated)
+                if draft is not None:
+                    record_acceptance(metrics, drafts.calls, generated, timer.steps)
+        except Exception as e:
+            errors.append(e)
+            streamer.end()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    for piece in streamer:
+        yield piece
+    thread.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,381 @@
+import os
+from collections import deque
+from concurrent.futures import Future
+
+import torch
+
+from cache import GENERATION, generation_key
+from chunking import chunk_token_budget, context_window, count_tokens, iter_chunks
+from constrained import schema_logits_processor
+from merging import ResultMerger, parse_json_response
+from metrics import Metrics, rss_bytes
+from model_registry import model_id
+from prompts import compact_schema
+from rules import apply_findings
+from speculative import DraftCounter, assisted_kwargs, record_acceptance
+from streaming import GenerationTimer, json_stopping_criteria, stream_generate
+
+# distilgpt2 has a 1024-token window; the criteria prompt takes most of it,
+# so generation has to leave room for some document text in every chunk
+MAX_NEW_TOKENS = 256
+OVERLAP_TOKENS = 64
+BATCH_SIZE = 8
+# Low-memory mode: a peak-memory budget in MB (0: none). Generation batches are cut to the
+# rows whose activations fit between the RSS at the start of a run and the budget.
+MEMORY_BUDGET_MB = int(os.environ.get("TENDER_LLM_MEMORY_BUDGET_MB", "0"))
+TEXT_MARKER = "\x00"
+
+
+def prepare_batching(tokenizer, model=None):
+    # GPT-2 family tokenizers ship without a pad token and pad on the right,
+    # which breaks batched generation; reuse EOS and pad on the left instead
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    if model is not None and model.config.pad_token_id is None:
+        model.config.pad_token_id = tokenizer.pad_token_id
+
+
+def generate_batch(nlp, batch_ids, max_new_tokens, schemas=None, prefix_len=0, prefix_cache=None, metrics=None):
+    # Left-pad a list of prompts (token ids) into one tensor and generate them in a single call;
+    # returns only the newly generated text for each prompt. Each row stops decoding once its
+    # JSON object is closed, and the call returns when every row has stopped. With schemas
+    # (one per prompt), decoding is constrained to the compact JSON object for that schema.
+    # With a prefix_cache, every prompt must start with the same prefix_len ids: generation
+    # resumes from that prefix's cached past_key_values, and padding goes after the prefix
+    # (the attention mask keeps positions contiguous). With a draft model on the pipeline,
+    # prompts are generated one at a time with assisted generation and without the prefix
+    # cache. With metrics, prefill and decode time, the generated token count and (when
+    # assisted) draft acceptance are recorded.
+    model = nlp.model
+    tokenizer = nlp.tokenizer
+    draft = getattr(nlp, "draft_model", None)
+    if draft is not None and len(batch_ids) > 1:
+        # Assisted generation verifies a single sequence per call
+        return [
+            text
+            for i, ids in enumerate(batch_ids)
+            for text in generate_batch(nlp, [ids], max_new_tokens, schemas[i:i + 1] if schemas else None,
+                                       metrics=metrics)
+        ]
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    if prefix_cache is None or draft is not None:
+        prefix_len = 0
+    prefix = list(batch_ids[0][:prefix_len])
+    width = max(len(ids) for ids in batch_ids)
+    rows = [prefix + [pad_id] * (width - len(ids)) + list(ids[prefix_len:]) for ids in batch_ids]
+    mask = [[1] * prefix_len + [0] * (width - len(ids)) + [1] * (len(ids) - prefix_len) for ids in batch_ids]
+    input_ids = torch.tensor(rows, device=model.device)
+    attention_mask = torch.tensor(mask, device=model.device)
+    stopping_criteria = json_stopping_criteria(tokenizer, width)
+    timer = GenerationTimer(metrics) if metrics is not None else None
+    if timer is not None:
+        stopping_criteria.append(timer)
+    with torch.inference_mode(), DraftCounter(draft) as drafts:
+        past = prefix_cache.past_for_batch(nlp, prefix, len(rows)) if prefix_len else None
+        output = model.generate(
+            input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past,
+            max_new_tokens=max_new_tokens,
+            pad_token_id=pad_id,
+            stopping_criteria=stopping_criteria,
+            logits_processor=schema_logits_processor(tokenizer, schemas, width, max_new_tokens) if schemas else None,
+            **assisted_kwargs(nlp),
+        )
+    if timer is not None:
+        timer.finish()
+        generated = int((output[:, width:] != pad_id).sum())
+        metrics.count("generated_tokens", generated)
+        if draft is not None:
+            record_acceptance(metrics, drafts.calls, generated, timer.steps)
+    return [tokenizer.decode(row[width:], skip_special_tokens=True) for row in output]
+
+
+def row_bytes(model, width):
+    # Rough peak activation memory of one generated row of width tokens: the KV cache of
+    # every layer plus the float32 logits of the prefill forward pass
+    config = model.config
+    itemsize = next(model.parameters()).element_size()
+    return width * (2 * config.num_hidden_layers * config.hidden_size * itemsize + config.vocab_size * 4)
+
+
+def budget_batch_size(nlp, memory_budget, batch_size=BATCH_SIZE):
+    # Largest batch, between 1 and batch_size, that fits in memory_budget (bytes) at the current RSS
+    free = memory_budget - rss_bytes()
+    row = row_bytes(nlp.model, context_window(nlp.tokenizer, nlp.model))
+    return max(1, min(batch_size, free // row))
+
+
+def generation_params(max_new_tokens, constrained=False):
+    # Everything besides the prompt that changes the generated text; part of the cache key
+    return {"max_new_tokens": max_new_tokens, "stop": "json_object", "constrained": constrained}
+
+
+def _chunk_output(chunk, text, cached, metrics):
+    # Chunks fully resolved by rules have no prompt and an empty output
+    with metrics.timer("json_parse"):
+        parsed = parse_json_response(text) if chunk["input_ids"] is not None else {}
+    return {
+        "chunk": chunk["index"],
+        "pages": chunk["pages"],
+        "headings": chunk.get("headings"),
+        "output": text,
+        "parsed": apply_findings(parsed, chunk.get("rule_findings")),
+        "rule_findings": chunk.get("rule_findings") or {},
+        "cached": cached and chunk["input_ids"] is not None,
+    }
+
+
+def _extraction(outputs, merger, metrics):
+    with metrics.timer("json_parse"):
+        return {"result": merger.result(), "provenance": merger.provenance(), "chunks": outputs}
+
+
+def _add_output(outputs, merger, output, metrics):
+    # Chunks are folded into their document's merger as they finish
+    outputs.append(output)
+    with metrics.timer("json_parse"):
+        merger.add_chunk(output)
+
+
+def _finish_batch(batch, generated, missing, keys, jobs, outputs, mergers, cache, metrics, on_chunk):
+    for group, texts in jobs:
+        if isinstance(texts, Future):
+            texts = texts.result()
+        for i, text in zip(group, texts):
+            generated[i] = text
+            if cache is not None:
+                cache.put(GENERATION, keys[i], text)
+    for i, ((doc_index, chunk), text) in enumerate(zip(batch, generated)):
+        output = _chunk_output(chunk, text, i not in missing, metrics)
+        _add_output(outputs[doc_index], mergers[doc_index], output, metrics)
+        if on_chunk is not None:
+            on_chunk(doc_index, output, mergers[doc_index])
+
+
+def _prefix_groups(batch, indices, prefix_cache):
+    # Rows can only share a cached prefix if their prompt headers are identical
+    if not indices:
+        return []
+    if prefix_cache is None:
+        return [indices]
+    groups = {}
+    for i in indices:
+        chunk = batch[i][1]
+        groups.setdefault(tuple(chunk["input_ids"][:chunk["prefix_len"]]), []).append(i)
+    return list(groups.values())
+
+
+def _batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _full_prompt(tokenizer, criteria, build_prompt):
+    # Split the full prompt around the text so its header can be tokenized once and shared;
+    # returns the header ids before the text, the text after it and the header's token count
+    prefix_text, suffix_text = build_prompt(TEXT_MARKER, criteria).split(TEXT_MARKER)
+    prefix_ids = tokenizer(prefix_text, add_special_tokens=False)["input_ids"]
+    return prefix_ids, suffix_text, len(prefix_ids) + count_tokens(tokenizer, suffix_text)
+
+
+def fit_max_new_tokens(nlp, criteria, build_prompt, max_new_tokens=MAX_NEW_TOKENS, prompt_builder=None):
+    # The full indented criteria schema (used without a prompt_builder) is about 800 GPT-2
+    # tokens, so on a 1024-token model MAX_NEW_TOKENS would leave no room for document
+    # text. Generation then gets at most half of what the header leaves, the text the rest.
+    if prompt_builder is not None:
+        return max_new_tokens
+    header_tokens = _full_prompt(nlp.tokenizer, criteria, build_prompt)[2]
+    room = context_window(nlp.tokenizer, nlp.model) - header_tokens
+    return max(1, min(max_new_tokens, room // 2))
+
+
+def iter_document_chunks(document, nlp, criteria, build_prompt, max_new_tokens=MAX_NEW_TOKENS,
+                         overlap_tokens=OVERLAP_TOKENS, keyword_index=None, prompt_builder=None, metrics=None,
+                         rules=None, retriever=None):
+    # Lazily split a document into windows that fit the model and build the prompt ids for each;
+    # chunk["prefix_len"] counts the leading ids (instructions and schema) shared with other chunks.
+    # document is either a string or an iterable of (page_number, text) pairs, e.g. from
+    # extract_text.iter_pdf_pages. With a keyword_index, only passages mentioning a criteria
+    # keyword are kept; with a prompt_builder, each chunk is prompted only for the headings it hit.
+    # With rules (a rules.RuleExtractor), headings it resolves confidently are recorded in
+    # chunk["rule_findings"] and left out of the prompt; a chunk with nothing left for the
+    # model is yielded with input_ids None and is never generated. With a retriever (a
+    # retrieval.Retriever), the whole document is read first and only the passages ranked
+    # highest for some heading are chunked, each chunk routed the headings that chose it.
+    metrics = metrics if metrics is not None else Metrics()
+    tokenizer = nlp.tokenizer
+    window = context_window(tokenizer, nlp.model)
+    if prompt_builder is not None:
+        header_tokens = prompt_builder.header_tokens()
+    else:
+        prefix_ids, suffix_text, header_tokens = _full_prompt(tokenizer, criteria, build_prompt)
+    budget = chunk_token_budget(header_tokens, max_new_tokens, window)
+
+    if isinstance(document, str):
+        pages = [(None, document)]
+    else:
+        # Pages may be parsed lazily (or waited for from a prefetch thread) as chunking pulls them
+        pages = metrics.timed(document, "pdf_parse")
+    if retriever is not None:
+        with metrics.timer("retrieval"):
+            pages, keyword_index = retriever.route(nlp, pages, keyword_index, metrics)
+    elif keyword_index is not None:
+        pages = ((n, keyword_index.filter_text(page_text)) for n, page_text in pages)
+        pages = metrics.timed(((n, page_text) for n, page_text in pages if page_text), "keyword_filter")
+
+    for chunk in metrics.timed(iter_chunks(pages, tokenizer, budget, overlap_tokens), "chunking"):
+        if keyword_index is not None:
+            with metrics.timer("keyword_filter"):
+                chunk["headings"] = sorted(keyword_index.headings_in(chunk["text"]))
+            if not chunk["headings"]:
+                continue
+        if rules is not None:
+            with metrics.timer("rules"):
+                chunk["rule_findings"] = rules.resolve(chunk["text"])
+            metrics.count("rule_fields", len(chunk["rule_findings"]))
+            if keyword_index is not None and prompt_builder is not None:
+                chunk["headings"] = [h for h in chunk["headings"] if h not in chunk["rule_findings"]]
+                if not chunk["headings"]:
+                    chunk["input_ids"], chunk["prefix_len"], chunk["schema"] = None, 0, None
+                    metrics.count("rule_only_chunks")
+                    yield chunk
+                    continue
+        with metrics.timer("tokenize"):
+            if prompt_builder is not None:
+                prompt = prompt_builder.build(chunk["text"], chunk.get("headings"))
+                chunk["input_ids"] = prompt["input_ids"]
+                chunk["prefix_len"] = prompt["prefix_len"]
+                chunk["schema"] = compact_schema(criteria, chunk.get("headings") or None)
+            else:
+                rest = tokenizer(chunk["text"] + suffix_text, add_special_tokens=False)["input_ids"]
+                chunk["input_ids"] = prefix_ids + rest
+                chunk["prefix_len"] = len(prefix_ids)
+                chunk["schema"] = compact_schema(criteria)
+        metrics.count("chunks")
+        metrics.count("prompt_tokens", len(chunk["input_ids"]))
+        yield chunk
+
+
+def run_batch_extraction(documents, nlp, criteria, build_prompt, max_new_tokens=MAX_NEW_TOKENS,
+                         overlap_tokens=OVERLAP_TOKENS, keyword_index=None, prompt_builder=None,
+                         batch_size=BATCH_SIZE, cache=None, constrained=False, prefix_cache=None, metrics=None,
+                         replicas=None, rules=None, retriever=None, on_chunk=None, memory_budget=None):
+    # Chunk every document, generate the chunks in padded batches as soon as a batch
+    # fills (so generation starts before a streamed document is fully read) and merge
+    # the per-chunk JSON back into one criteria-shaped result per document.
+    # With a cache, chunks whose exact prompt was generated before are not regenerated;
+    # with constrained, every output is forced to be valid JSON in the chunk's schema;
+    # with a prefix_cache, chunks sharing a prompt header are generated together from its KV cache;
+    # with metrics, stage timings and token/cache counters are recorded for the whole call;
+    # with replicas (a replicas.ReplicaPool), batches are generated in parallel by the pool's
+    # worker processes while the next batches are being chunked; with rules, fields the rule
+    # extractor resolves confidently are filled without asking the model for them; with a
+    # retriever, each document is cut down to its best-matching passages per heading.
+    # on_chunk(doc_index, output, merger) is called as each chunk is merged (e.g. to report
+    # progress and partial results); an exception it raises aborts the extraction. With a
+    # memory_budget (bytes), batches are made no larger than fits in it; pass documents as
+    # extract_text.PageStore objects so only the active chunk window of each is in memory.
+    metrics = metrics if metrics is not None else Metrics()
+    prepare_batching(nlp.tokenizer, nlp.model)
+    if memory_budget:
+        batch_size = budget_batch_size(nlp, memory_budget, batch_size)
+    model_name = model_id(nlp)
+    max_new_tokens = fit_max_new_tokens(nlp, criteria, build_prompt, max_new_tokens, prompt_builder)
+    params = generation_params(max_new_tokens, constrained)
+    stream = (
+        (doc_index, chunk)
+        for doc_index, document in enumerate(documents)
+        for chunk in iter_document_chunks(document, nlp, criteria, build_prompt, max_new_tokens,
+                                          overlap_tokens, keyword_index, prompt_builder, metrics, rules,
+                                          retriever)
+    )
+    outputs = [[] for _ in documents]
+    mergers = [ResultMerger(criteria) for _ in documents]
+    in_flight = deque()
+    for batch in _batched(stream, batch_size):
+        prompted = [i for i, (_, chunk) in enumerate(batch) if chunk["input_ids"] is not None]
+        generated = [None if chunk["input_ids"] is not None else "" for _, chunk in batch]
+        keys = None
+        if cache is not None:
+            keys = {i: generation_key(model_name, batch[i][1]["input_ids"], params) for i in prompted}
+            for i in prompted:
+                generated[i] = cache.get(GENERATION, keys[i])
+        missing = [i for i, text in enumerate(generated) if text is None]
+        if cache is not None:
+            metrics.count("generation_cache_hits", len(prompted) - len(missing))
+            metrics.count("generation_cache_misses", len(missing))
+        jobs = []
+        # Every replica keeps its own prefix cache, so their batches are always split by header
+        for group in _prefix_groups(batch, missing, prefix_cache if replicas is None else replicas):
+            batch_ids = [batch[i][1]["input_ids"] for i in group]
+            schemas = [batch[i][1]["schema"] for i in group] if constrained else None
+            prefix_len = batch[group[0]][1]["prefix_len"]
+            if replicas is not None:
+                texts = replicas.submit(batch_ids, max_new_tokens, schemas, prefix_len, metrics)
+            else:
+                texts = generate_batch(nlp, batch_ids, max_new_tokens, schemas, prefix_len, prefix_cache, metrics)
+            jobs.append((group, texts))
+        in_flight.append((batch, generated, missing, keys, jobs))
+        # Keep one batch queued per replica; without replicas each batch completes at once
+        while len(in_flight) > (replicas.size if replicas is not None else 0):
+            _finish_batch(*in_flight.popleft(), outputs, mergers, cache, metrics, on_chunk)
+    while in_flight:
+        _finish_batch(*in_flight.popleft(), outputs, mergers, cache, metrics, on_chunk)
+
+    return [_extraction(doc_outputs, merger, metrics) for doc_outputs, merger in zip(outputs, mergers)]
+
+
+def iter_streaming_extraction(document, nlp, criteria, build_prompt, max_new_tokens=MAX_NEW_TOKENS,
+                              overlap_tokens=OVERLAP_TOKENS, keyword_index=None, prompt_builder=None, cache=None,
+                              constrained=False, prefix_cache=None, metrics=None, rules=None, retriever=None):
+    # Generate chunk by chunk and yield events as tokens arrive:
+    #   {"event": "token", "chunk": i, "text": piece}
+    #   {"event": "chunk", "chunk": i, ...per-chunk output...}
+    #   {"event": "done", "result": {...}, "chunks": [...]}
+    metrics = metrics if metrics is not None else Metrics()
+    prepare_batching(nlp.tokenizer, nlp.model)
+    model_name = model_id(nlp)
+    max_new_tokens = fit_max_new_tokens(nlp, criteria, build_prompt, max_new_tokens, prompt_builder)
+    params = generation_params(max_new_tokens, constrained)
+    outputs = []
+    merger = ResultMerger(criteria)
+    for chunk in iter_document_chunks(document, nlp, criteria, build_prompt, max_new_tokens,
+                                      overlap_tokens, keyword_index, prompt_builder, metrics, rules, retriever):
+        if chunk["input_ids"] is None:
+            output = _chunk_output(chunk, "", False, metrics)
+            _add_output(outputs, merger, output, metrics)
+            yield dict(output, event="chunk")
+            continue
+        key = generation_key(model_name, chunk["input_ids"], params) if cache is not None else None
+        text = cache.get(GENERATION, key) if cache is not None else None
+        cached = text is not None
+        if cache is not None:
+            metrics.count("generation_cache_hits" if cached else "generation_cache_misses")
+        if cached:
+            yield {"event": "token", "chunk": chunk["index"], "text": text}
+        else:
+            pieces = []
+            schema = chunk["schema"] if constrained else None
+            for piece in stream_generate(nlp, chunk["input_ids"], max_new_tokens, schema,
+                                         chunk["prefix_len"], prefix_cache, metrics):
+                pieces.append(piece)
+                yield {"event": "token", "chunk": chunk["index"], "text": piece}
+            text = "".join(pieces)
+            if cache is not None:
+                cache.put(GENERATION, key, text)
+        output = _chunk_output(chunk, text, cached, metrics)
+        _add_output(outputs, merger, output, metrics)
+        yield dict(output, event="chunk")
+    yield dict(_extraction(outputs, merger, metrics), event="done")
+
+
+def run_extraction(document, nlp, criteria, build_prompt, **options):
+    return run_batch_extraction([document], nlp, criteria, build_prompt, **options)[0]
@@ -0,0 +1,135 @@
+import re
+
+# Separators tried in order when a piece of text is too long for one chunk:
+# page breaks, blank lines, numbered clauses, lines, sentences, words.
+PAGE_BREAK = "\f"
+CLAUSE_START = re.compile(
+    r"\n(?=[ \t]*(?:\d+(?:\.\d+)*[.)]?[ \t]+\S|\(?[a-zA-Z0-9]{1,4}\)[ \t]+\S|"
+    r"(?i:clause|section|article)[ \t]+\d|[A-Z][A-Z0-9 ,&/-]{3,}\n))"
+)
+SEPARATORS = [
+    re.compile(re.escape(PAGE_BREAK)),
+    re.compile(r"\n[ \t]*\n"),
+    CLAUSE_START,
+    re.compile(r"\n"),
+    re.compile(r"(?<=[.;:])[ \t]+"),
+    re.compile(r"[ \t]+"),
+]
+
+DEFAULT_CONTEXT_WINDOW = 1024
+MIN_CHUNK_TOKENS = 32
+
+
+def context_window(tokenizer, model=None):
+    # Prefer the model's position limit; tokenizers sometimes report a huge sentinel
+    if model is not None:
+        limit = getattr(model.config, "max_position_embeddings", None)
+        if limit:
+            return limit
+    limit = getattr(tokenizer, "model_max_length", None)
+    if limit and limit < 1_000_000:
+        return limit
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def count_tokens(tokenizer, text):
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def chunk_token_budget(header_tokens, max_new_tokens, window=DEFAULT_CONTEXT_WINDOW):
+    # Tokens left for document text once the fixed prompt and the generation are accounted for
+    budget = window - header_tokens - max_new_tokens
+    if budget < MIN_CHUNK_TOKENS:
+        raise ValueError(
+            f"Prompt header ({header_tokens} tokens) plus max_new_tokens "
+            f"({max_new_tokens}) leaves only {budget} tokens of the {window}-token context "
+            f"window for document text; lower max_new_tokens or shorten the prompt."
+        )
+    return budget
+
+
+def _split(text, level):
+    # Split on the separator at `level`, keeping the separator attached to the left piece
+    pattern = SEPARATORS[level]
+    pieces = []
+    start = 0
+    for match in pattern.finditer(text):
+        end = match.end()
+        if end > start:
+            pieces.append(text[start:end])
+            start = end
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+
+def _hard_split(text, tokenizer, budget):
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    return [tokenizer.decode(ids[i:i + budget]) for i in range(0, len(ids), budget)]
+
+
+def _units(text, tokenizer, budget, level=0):
+    # Break text into (piece, n_tokens) units no larger than the budget,
+    # preferring the coarsest boundary that fits
+    n_tokens = count_tokens(tokenizer, text)
+    if n_tokens <= budget:
+        return [(text, n_tokens)]
+    if level >= len(SEPARATORS):
+        return [(piece, count_tokens(tokenizer, piece)) for piece in _hard_split(text, tokenizer, budget)]
+    pieces = _split(text, level)
+    if len(pieces) == 1:
+        return _units(text, tokenizer, budget, level + 1)
+    units = []
+    for piece in pieces:
+        units.extend(_units(piece, tokenizer, budget, level + 1))
+    return units
+
+
+def _make_chunk(index, units):
+    pages = []
+    for _, _, page in units:
+        if page is not None and page not in pages:
+            pages.append(page)
+    return {
+        "index": index,
+        "text": "".join(piece for piece, _, _ in units).strip(),
+        "n_tokens": sum(n for _, n, _ in units),
+        "pages": pages,
+    }
+
+
+def iter_chunks(pages, tokenizer, budget, overlap_tokens=64):
+    # Pack boundary-aligned units into token-budgeted windows; each window repeats
+    # the trailing units of the previous one (up to overlap_tokens) for context.
+    # pages is an iterable of (page_number, text) and is consumed lazily, so chunks
+    # are yielded while later pages are still being extracted.
+    overlap_tokens = min(overlap_tokens, budget // 4)
+    current = []
+    current_tokens = 0
+    index = 0
+    for page_number, page_text in pages:
+        if not page_text.endswith("\n"):
+            page_text += "\n"
+        for piece, n_tokens in _units(page_text, tokenizer, budget):
+            if not piece.strip():
+                continue
+            if current and current_tokens + n_tokens > budget:
+                yield _make_chunk(index, current)
+                index += 1
+                carried = []
+                carried_tokens = 0
+                for prev in reversed(current):
+                    if carried_tokens + prev[1] > overlap_tokens or carried_tokens + prev[1] + n_tokens > budget:
+                        break
+                    carried.insert(0, prev)
+                    carried_tokens += prev[1]
+                current = carried
+                current_tokens = carried_tokens
+            current.append((piece, n_tokens, page_number))
+            current_tokens += n_tokens
+    if current:
+        yield _make_chunk(index, current)
+
+
+def chunk_text(text, tokenizer, budget, overlap_tokens=64):
+    return list(iter_chunks([(None, text)], tokenizer, budget, overlap_tokens))
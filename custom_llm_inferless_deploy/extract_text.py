@@ -0,0 +1,163 @@
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+
+import PyPDF2
+
+_DONE = object()
+
+# Below this many pages, process start-up costs more than serial extraction
+PARALLEL_MIN_PAGES = 32
+
+
+def iter_pdf_pages(pdf):
+    # Yield (page_number, text) as each page is parsed so downstream stages can start
+    # before the whole document is read; pdf may be a path or a binary file object
+    reader = PyPDF2.PdfReader(pdf)
+    for page_number, page in enumerate(reader.pages, start=1):
+        page_text = page.extract_text()
+        if page_text:
+            yield page_number, page_text
+
+
+def pdf_page_count(pdf):
+    # Every page, including the blank or scanned ones iter_pdf_pages skips
+    return len(PyPDF2.PdfReader(pdf).pages)
+
+
+def load_document(path):
+    # A PDF becomes its list of (page_number, text), anything else is read as text. Used as
+    # the worker of batch_extract's process pool, so it lives here with no torch imports.
+    if path.lower().endswith(".pdf"):
+        return list(iter_pdf_pages(path))
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def _extract_page_range(pdf_path, start, stop):
+    # Worker: open the file itself through a read-only memory map (nothing large is
+    # pickled across the process boundary) and extract pages [start, stop)
+    with open(pdf_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        reader = PyPDF2.PdfReader(buffer)
+        pages = []
+        for index in range(start, stop):
+            page_text = reader.pages[index].extract_text()
+            if page_text:
+                pages.append((index + 1, page_text))
+        return pages
+
+
+def iter_pdf_pages_parallel(pdf_path, workers=None, pages_per_task=None):
+    # Same output as iter_pdf_pages, but page ranges are extracted across a process pool
+    # and yielded in page order as each range completes
+    workers = workers or os.cpu_count() or 1
+    with open(pdf_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        n_pages = len(PyPDF2.PdfReader(buffer).pages)
+    if workers == 1 or n_pages < PARALLEL_MIN_PAGES:
+        yield from iter_pdf_pages(pdf_path)
+        return
+    # A few ranges per worker keeps the pool balanced when some pages are much slower
+    pages_per_task = pages_per_task or max(1, -(-n_pages // (workers * 4)))
+    # spawn rather than fork: the caller may already hold torch/OpenMP threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [
+            pool.submit(_extract_page_range, pdf_path, start, min(start + pages_per_task, n_pages))
+            for start in range(0, n_pages, pages_per_task)
+        ]
+        for future in futures:
+            yield from future.result()
+
+
+class PageStore:
+    # Low-memory mode: extracted page text spilled to an anonymous temporary file as it is
+    # parsed, so a large document is never held in memory whole. Only an index of page
+    # numbers and byte ranges stays resident; iterating reads pages back one at a time,
+    # which lets the chunker keep just its active window. Supports len() and indexing for
+    # previews. The file is deleted on close().
+    def __init__(self, pages=(), directory=None):
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._index = []
+        self._lock = threading.Lock()
+        self.chars = 0
+        for page_number, page_text in pages:
+            self.append(page_number, page_text)
+
+    def append(self, page_number, page_text):
+        data = page_text.encode("utf-8")
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            self._index.append((page_number, self._file.tell(), len(data)))
+            self._file.write(data)
+        self.chars += len(page_text)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, i):
+        page_number, offset, size = self._index[i]
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(size)
+        return page_number, data.decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self._index)):
+            yield self[i]
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def join_pages(pages):
+    return "".join(page_text + "\n" for _, page_text in pages)
+
+
+def extract_text_from_pdf(pdf_path, workers=1):
+    if workers == 1:
+        return join_pages(iter_pdf_pages(pdf_path))
+    return join_pages(iter_pdf_pages_parallel(pdf_path, workers))
+
+
+def prefetch(iterable, buffer_size=8):
+    # Run the producer in a background thread so page parsing overlaps with
+    # model generation (which releases the GIL) in the consumer
+    queue = Queue(maxsize=buffer_size)
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put(item)
+        except Exception as e:
+            queue.put(e)
+        queue.put(_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = queue.get()
+        if item is _DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python extract_text.py <pdf_path> [workers]")
+        sys.exit(1)
+    pdf_path = sys.argv[1]
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    for _, page_text in iter_pdf_pages_parallel(pdf_path, workers):
+        sys.stdout.write(page_text + "\n")
+        sys.stdout.flush()
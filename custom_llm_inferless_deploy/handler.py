@@ -1,11 +1,32 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+import time
+
+_IMPORT_START = time.perf_counter()
+
+import base64
+import io
 import json
+import multiprocessing
+import os
+import threading
+from cache import ResultCache
+from keyword_index import KeywordIndex
+from metrics import METRICS, METRICS_FILE, Metrics
+from prompts import PromptBuilder
+from rules import RuleExtractor
 
-# Load model and tokenizer at startup
+# torch/transformers are imported and the model is loaded on first use (or by warmup()),
+# not at import time. Point TENDER_LLM_SNAPSHOT at a directory written by
+# `python snapshot.py <model> <dir>` to load memory-mapped safetensors from local disk
+# instead of resolving MODEL_NAME through the Hub cache.
 MODEL_NAME = "distilgpt2"  # Change to your fine-tuned or lightweight model if needed
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-model = AutoModelForCausalLM.from_pretrained(MODEL_NAME)
-nlp = pipeline("text-generation", model=model, tokenizer=tokenizer)
+SNAPSHOT_DIR = os.environ.get("TENDER_LLM_SNAPSHOT")
+# With TENDER_LLM_REPLICAS=N (-1: one per TENDER_LLM_THREADS_PER_REPLICA cores), chunks
+# are generated on N core-pinned model replicas in worker processes (see replicas.py)
+REPLICAS = int(os.environ.get("TENDER_LLM_REPLICAS", "0"))
+WARMUP_TEXT = "The bidder shall submit an Earnest Money Deposit (EMD) of Rs. 5,00,000."
+# Seconds spent importing this module, importing torch/transformers and the pipeline
+# modules, loading the model and warming it up; filled in as each step happens
+STARTUP = {}
 
 # Extraction criteria (replace with your full schema as needed)
 CRITERIA = {
@@ -138,6 +159,14 @@ CRITERIA = {
     }
 }
 
+KEYWORD_INDEX = KeywordIndex(CRITERIA)
+RULES = RuleExtractor(CRITERIA)
+CACHE = ResultCache()
+_loaded = {}
+_load_lock = threading.Lock()
+_job_queue = None
+_job_lock = threading.Lock()
+
 def build_prompt(text, criteria):
     return f"""
 You are an expert tender document analyst. Given the following text chunk from a tender document, extract all information relevant to the following criteria, grouping your findings under each heading. If nothing is found for a heading, write "Not found".
@@ -153,9 +182,287 @@ Text chunk:
 Respond in JSON format matching the criteria structure.
 """
 
+def load():
+    # Import the heavy modules and load the model once; later calls return the same objects
+    with _load_lock:
+        if not _loaded:
+            start = time.perf_counter()
+            import tender_pipeline
+            from model_registry import DRAFT_MODEL, get_pipeline
+            from prefix_cache import PrefixCache
+            from retrieval import EmbeddingStore, Retriever
+            imported = time.perf_counter()
+            source = SNAPSHOT_DIR if SNAPSHOT_DIR and os.path.isdir(SNAPSHOT_DIR) else MODEL_NAME
+            replicas = None
+            if REPLICAS:
+                from replicas import ReplicaPool
+                replicas = ReplicaPool(source, REPLICAS if REPLICAS > 0 else None, draft=DRAFT_MODEL)
+                source = replicas.model_name
+            nlp = get_pipeline(source, draft=DRAFT_MODEL)
+            _loaded.update(
+                nlp=nlp,
+                pipeline=tender_pipeline,
+                prompt_builder=PromptBuilder(nlp.tokenizer, CRITERIA),
+                # KV cache of the shared instruction+schema prompt headers, computed once per header
+                prefix_cache=PrefixCache(),
+                replicas=replicas,
+                retriever=Retriever(CRITERIA, store=EmbeddingStore()),
+            )
+            STARTUP.update(
+                model_source=source,
+                draft_model=DRAFT_MODEL,
+                library_import_seconds=round(imported - start, 3),
+                load_seconds=round(time.perf_counter() - imported, 3),
+            )
+            print(f"Loaded {source}: imports {STARTUP['library_import_seconds']}s, "
+                  f"model load {STARTUP['load_seconds']}s")
+    return _loaded
+
+
+def warmup():
+    # Load the model and run one short extraction, so the first real request does not pay
+    # for lazy initialisation (prefix KV cache, constrained-decoding vocabulary, kernels)
+    start = time.perf_counter()
+    _extract({"text": WARMUP_TEXT, "use_cache": False, "rules": False}, Metrics())
+    STARTUP["warmup_seconds"] = round(time.perf_counter() - start, 3)
+    return STARTUP
+
+
+def __getattr__(name):
+    # handler.nlp, handler.tokenizer and handler.model load the model on first access
+    if name in ("nlp", "tokenizer", "model"):
+        nlp = load()["nlp"]
+        return {"nlp": nlp, "tokenizer": nlp.tokenizer, "model": nlp.model}[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _options(request, loaded, metrics):
+    # Pipeline keyword arguments shared by infer(), infer_stream() and jobs
+    return dict(
+        keyword_index=KEYWORD_INDEX,
+        prompt_builder=None if request.get("prompt_mode") == "full" else loaded["prompt_builder"],
+        cache=CACHE if request.get("use_cache", True) else None,
+        constrained=request.get("constrained", True),
+        prefix_cache=loaded["prefix_cache"],
+        metrics=metrics,
+        rules=RULES if request.get("rules", True) else None,
+        retriever=loaded["retriever"] if request.get("retrieval") else None,
+    )
+
+
+def _memory_budget(request, loaded):
+    # Low-memory mode budget in bytes; TENDER_LLM_MEMORY_BUDGET_MB unless the request sets one
+    return int(request.get("memory_budget_mb", loaded["pipeline"].MEMORY_BUDGET_MB)) * 2**20
+
+
+def _response(extraction):
+    return {
+        "output": extraction["result"],
+        "provenance": extraction["provenance"],
+        "chunks": [c["output"] for c in extraction["chunks"]],
+    }
+
+
+def validate_request(request, job=False):
+    # Raises ValueError for a request the pipeline cannot run. serve.py checks every
+    # request before merging it into a micro-batch, so one malformed request is turned
+    # away on its own instead of failing the generate call it would have shared.
+    # A job (job=True) extracts one document, its "text" or the PDF in "pdf_base64".
+    if not isinstance(request, dict):
+        raise ValueError("The request must be a JSON object")
+    if job:
+        if "texts" in request:
+            raise ValueError('A job extracts one document: send "text" or "pdf_base64", not "texts"')
+        if "pdf_base64" in request:
+            _decode_pdf(request["pdf_base64"])
+    if "texts" in request:
+        if not isinstance(request["texts"], list) or not all(isinstance(t, str) for t in request["texts"]):
+            raise ValueError('"texts" must be a list of strings')
+    elif not isinstance(request.get("text", ""), str):
+        raise ValueError('"text" must be a string')
+    if request.get("prompt_mode") not in (None, "compact", "full"):
+        raise ValueError('"prompt_mode" must be "compact" or "full"')
+    for flag in ("use_cache", "constrained", "rules", "retrieval", "metrics"):
+        if not isinstance(request.get(flag, False), bool):
+            raise ValueError(f'"{flag}" must be true or false')
+    batch_size = request.get("batch_size", 1)
+    if isinstance(batch_size, bool) or not isinstance(batch_size, int) or batch_size < 1:
+        raise ValueError('"batch_size" must be a positive integer')
+    memory_budget_mb = request.get("memory_budget_mb", 0)
+    if isinstance(memory_budget_mb, bool) or not isinstance(memory_budget_mb, (int, float)) or memory_budget_mb < 0:
+        raise ValueError('"memory_budget_mb" must be a non-negative number')
+
+
+def _decode_pdf(pdf_base64):
+    if not isinstance(pdf_base64, str):
+        raise ValueError('"pdf_base64" must be a base64 string')
+    try:
+        # Line breaks (wrapped base64) are fine; any other character outside the alphabet is not
+        return base64.b64decode("".join(pdf_base64.split()), validate=True)
+    except ValueError as e:
+        raise ValueError(f'"pdf_base64" is not valid base64: {e}') from None
+
+
+def _extract(request, metrics):
+    loaded = load()
+    texts = request.get("texts")
+    extractions = loaded["pipeline"].run_batch_extraction(
+        texts if texts is not None else [request.get("text", "")],
+        loaded["nlp"], CRITERIA, build_prompt,
+        batch_size=int(request.get("batch_size", loaded["pipeline"].BATCH_SIZE)),
+        replicas=loaded["replicas"],
+        memory_budget=_memory_budget(request, loaded),
+        **_options(request, loaded, metrics),
+    )
+    responses = [_response(e) for e in extractions]
+    return {"outputs": responses} if texts is not None else responses[0]
+
+
 def infer(request):
-    # request is a dict with a "text" field
-    text = request.get("text", "")
-    prompt = build_prompt(text, CRITERIA)
-    response = nlp(prompt, max_new_tokens=1024)[0]['generated_text']
-    return {"output": response}
+    # request is a dict with a "text" field, or a "texts" list that is generated as
+    # padded batches of "batch_size" chunks; "prompt_mode": "full" sends the whole
+    # CRITERIA schema with every chunk instead of only the headings it matched (with
+    # max_new_tokens cut to fit short windows such as the default distilgpt2's);
+    # "use_cache": false regenerates chunks that were generated before;
+    # "constrained": false lets the model write free-form text instead of schema JSON;
+    # "rules": false asks the model for every field, including the amounts, percentages
+    # and periods the rule extractor would otherwise read straight from the text;
+    # "retrieval": true sends only the passages that rank highest for each heading by
+    # embedding similarity, instead of every passage with a keyword hit;
+    # "memory_budget_mb" caps generation batches to what fits in that peak RSS;
+    # "metrics": true adds per-stage timings, token/cache counts and peak RSS to the response
+    validate_request(request)
+    metrics = Metrics()
+    with metrics.sampling_rss(bool(request.get("metrics"))):
+        response = _extract(request, metrics)
+    record_metrics(metrics)
+    if request.get("metrics"):
+        response["metrics"] = metrics.as_dict()
+    return response
+
+
+def infer_stream(request):
+    # Streaming variant of infer() for a single "text": yields token, per-chunk and
+    # final "done" events as they are produced (see serve.py's /infer/stream)
+    validate_request(request)
+    loaded = load()
+    metrics = Metrics()
+    events = loaded["pipeline"].iter_streaming_extraction(
+        request.get("text", ""), loaded["nlp"], CRITERIA, build_prompt, **_options(request, loaded, metrics)
+    )
+    with metrics.sampling_rss(bool(request.get("metrics"))):
+        for event in events:
+            if event["event"] == "done":
+                record_metrics(metrics)
+                if request.get("metrics"):
+                    event["metrics"] = metrics.as_dict()
+            yield event
+
+
+def run_job(request, document, report):
+    # jobs.JobQueue runner: document holds the PDF bytes of a PDF job, otherwise the
+    # request's "text" is extracted. Progress counts merged chunks against the page count.
+    # In low-memory mode (a memory budget is set) PDF pages are spilled to a temporary file.
+    loaded = load()
+    metrics = Metrics()
+    memory_budget = _memory_budget(request, loaded)
+    with metrics.sampling_rss(bool(request.get("metrics"))):
+        if document is not None:
+            from extract_text import PageStore, iter_pdf_pages, pdf_page_count
+            with metrics.timer("pdf_parse"):
+                pages = iter_pdf_pages(io.BytesIO(document))
+                source = PageStore(pages) if memory_budget else list(pages)
+            # last_page is a PDF page number; the page count includes pages without text
+            progress = {"chunks": 0, "pages": pdf_page_count(io.BytesIO(document)), "last_page": 0}
+        else:
+            source = request.get("text", "")
+            progress = {"chunks": 0}
+        report(progress)
+
+        def on_chunk(_, output, merger):
+            progress["chunks"] += 1
+            if output["pages"] and "last_page" in progress:
+                progress["last_page"] = max(progress["last_page"], *output["pages"])
+            report(dict(progress), merger.result())
+
+        try:
+            extraction = loaded["pipeline"].run_batch_extraction(
+                [source], loaded["nlp"], CRITERIA, build_prompt,
+                batch_size=int(request.get("batch_size", loaded["pipeline"].BATCH_SIZE)),
+                replicas=loaded["replicas"],
+                on_chunk=on_chunk,
+                memory_budget=memory_budget,
+                **_options(request, loaded, metrics),
+            )[0]
+        finally:
+            if hasattr(source, "close"):
+                source.close()
+    if "last_page" in progress:
+        # Keyword filtering may skip the last pages, so the run's end is reported explicitly
+        progress["last_page"] = progress["pages"]
+        report(progress, extraction["result"])
+    record_metrics(metrics)
+    response = _response(extraction)
+    if request.get("metrics"):
+        response["metrics"] = metrics.as_dict()
+    return response
+
+
+def job_queue():
+    # Created on first use; opening the queue re-queues jobs a previous process left unfinished
+    global _job_queue
+    with _job_lock:
+        if _job_queue is None:
+            from jobs import JobQueue
+            _job_queue = JobQueue(run_job, kind="handler")
+    return _job_queue
+
+
+def submit_job(request):
+    # Same options as infer() for a single "text", or a PDF sent as "pdf_base64";
+    # returns {"job_id"} at once and extracts in the background
+    validate_request(request, job=True)
+    request = dict(request)
+    pdf = request.pop("pdf_base64", None)
+    document = _decode_pdf(pdf) if pdf is not None else None
+    return {"job_id": job_queue().submit(request, document)}
+
+
+def job_status(job_id):
+    # None for unknown ids; "partial" is the merged result so far while the job runs
+    job = job_queue().status(job_id)
+    if job is None:
+        return None
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        "progress": job["progress"],
+        "partial": job["partial"],
+        "result": job["result"],
+        "error": job["error"],
+    }
+
+
+def cancel_job(job_id):
+    return {"job_id": job_id, "cancelled": job_queue().cancel(job_id)}
+
+
+def record_metrics(metrics):
+    # Add a request to the process-wide totals; with TENDER_LLM_METRICS_FILE set, the
+    # Prometheus text is rewritten after every request for a textfile collector to scrape
+    METRICS.record(metrics)
+    if METRICS_FILE:
+        METRICS.write(METRICS_FILE, cache_counters())
+
+
+def cache_counters():
+    if _loaded:
+        return {"result": CACHE, "prefix": _loaded["prefix_cache"], "embeddings": _loaded["retriever"].store}
+    return {"result": CACHE}
+
+
+STARTUP["handler_import_seconds"] = round(time.perf_counter() - _IMPORT_START, 3)
+# Not in child processes: spawned replica workers re-import the parent's __main__ (and so
+# this module), and warming up there would start another ReplicaPool while they bootstrap
+if os.environ.get("TENDER_LLM_WARMUP") == "1" and multiprocessing.parent_process() is None:
+    warmup()
@@ -0,0 +1,149 @@
+import json
+import re
+from difflib import SequenceMatcher
+
+from keyword_index import heading_name, heading_paths
+
+NOT_FOUND = "Not found"
+# Confidence of one model-generated finding; rule findings carry their own
+MODEL_CONFIDENCE = 0.6
+# Distinct findings kept per heading; beyond this the least supported one is dropped
+MAX_FINDINGS = 16
+NEAR_DUPLICATE_RATIO = 0.9
+_NON_WORD = re.compile(r"[^\w%]+")
+_DIGITS = re.compile(r"\d+")
+
+
+def parse_json_response(response):
+    # Decode the first JSON object in the generated text, ignoring anything the model rambles on with after it
+    decoder = json.JSONDecoder()
+    start = response.find("{")
+    while start != -1:
+        try:
+            obj, _ = decoder.raw_decode(response, start)
+            if isinstance(obj, dict):
+                return obj
+        except json.JSONDecodeError:
+            pass
+        start = response.find("{", start + 1)
+    return None
+
+
+def _is_empty(value):
+    if value is None:
+        return True
+    if isinstance(value, str):
+        return not value.strip() or value.strip().lower() == NOT_FOUND.lower()
+    if isinstance(value, (list, dict)):
+        return all(_is_empty(v) for v in (value.values() if isinstance(value, dict) else value))
+    return False
+
+
+def _values(value):
+    if isinstance(value, list):
+        return [v for v in value if not _is_empty(v)]
+    return [] if _is_empty(value) else [value]
+
+
+def _dedup_key(value):
+    text = value if isinstance(value, str) else json.dumps(value, sort_keys=True)
+    return _NON_WORD.sub(" ", text.lower()).strip()
+
+
+def _near_duplicate(a, b):
+    # Keys that differ only by small edits, and never in their numbers
+    # (Rs. 5,00,000 and Rs. 50,000 are different findings however similar they read)
+    if a == b:
+        return True
+    if "".join(_DIGITS.findall(a)) != "".join(_DIGITS.findall(b)):
+        return False
+    if min(len(a), len(b)) < NEAR_DUPLICATE_RATIO * max(len(a), len(b)):
+        return False
+    return SequenceMatcher(None, a, b, autojunk=False).ratio() >= NEAR_DUPLICATE_RATIO
+
+
+class ResultMerger:
+    # Streaming fold of per-chunk outputs into one criteria-shaped result. A finding that
+    # repeats an earlier one for the same heading (same wording up to case, punctuation and
+    # small edits, and the same numbers) is folded into it, collecting the pages and chunks
+    # it was seen in and raising its confidence; only distinct findings are kept, so memory
+    # does not grow with the number of chunks.
+    def __init__(self, criteria):
+        self.paths = [path for path, _ in heading_paths(criteria)]
+        self.findings = {heading_name(path): [] for path in self.paths}
+
+    def add(self, parsed, chunk=None, pages=(), rule_findings=None):
+        # parsed is one chunk's JSON object; rule_findings maps dotted headings to the
+        # rules.RuleExtractor findings that were written into it
+        rule_findings = rule_findings or {}
+        for path in self.paths:
+            name = heading_name(path)
+            node = parsed
+            for key in path:
+                node = node.get(key) if isinstance(node, dict) else None
+            rule = rule_findings.get(name)
+            for value in _values(node):
+                if rule is not None and value == rule["value"]:
+                    self._add(name, value, chunk, pages, "rules", rule["confidence"])
+                else:
+                    self._add(name, value, chunk, pages, "model", MODEL_CONFIDENCE)
+
+    def add_chunk(self, output):
+        # output is a per-chunk dict from tender_pipeline (parsed, chunk, pages, rule_findings)
+        self.add(output["parsed"], output["chunk"], output.get("pages") or (), output.get("rule_findings"))
+
+    def _add(self, name, value, chunk, pages, source, confidence):
+        key = _dedup_key(value)
+        findings = self.findings[name]
+        for finding in findings:
+            if _near_duplicate(finding["key"], key):
+                break
+        else:
+            finding = {"value": value, "key": key, "pages": [], "chunks": [], "sources": [], "miss": 1.0}
+            findings.append(finding)
+        # Noisy-or: each independent sighting lowers the chance that the value is wrong
+        finding["miss"] *= 1.0 - confidence
+        for field, item in (("chunks", chunk), ("sources", source)):
+            if item is not None and item not in finding[field]:
+                finding[field].append(item)
+        finding["pages"].extend(p for p in pages if p is not None and p not in finding["pages"])
+        if len(findings) > MAX_FINDINGS:
+            # Ties go against the newest finding
+            findings.remove(max(reversed(findings), key=lambda f: f["miss"]))
+
+    def result(self):
+        # Same shape as merge_results: each heading holds its distinct findings in the order
+        # they were first seen, a single finding on its own, or NOT_FOUND
+        merged = {}
+        for path in self.paths:
+            values = [f["value"] for f in self.findings[heading_name(path)]]
+            node = merged
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+            node[path[-1]] = NOT_FOUND if not values else values[0] if len(values) == 1 else values
+        return merged
+
+    def provenance(self):
+        # One row per finding (or a NOT_FOUND row per empty heading), most confident first
+        rows = []
+        for path in self.paths:
+            findings = sorted(self.findings[heading_name(path)], key=lambda f: f["miss"])
+            for f in findings or [None]:
+                rows.append({
+                    "field": " > ".join(path),
+                    "value": f["value"] if f else NOT_FOUND,
+                    "confidence": round(1.0 - f["miss"], 3) if f else None,
+                    "pages": sorted(f["pages"]) if f else [],
+                    "chunks": sorted(f["chunks"]) if f else [],
+                    "source": "+".join(f["sources"]) if f else None,
+                })
+        return rows
+
+
+def merge_results(results, criteria):
+    # Fold per-chunk JSON objects into a single result shaped like criteria;
+    # each heading keeps the distinct findings from every chunk in order
+    merger = ResultMerger(criteria)
+    for result in results:
+        merger.add(result)
+    return merger.result()
@@ -0,0 +1,118 @@
+import gc
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+
+from cpu_backend import DEFAULT_BACKEND, DEFAULT_COMPILE, configure_threads, prepare_model
+from snapshot import is_snapshot, load_snapshot
+from speculative import prepare_draft
+
+# Process-wide registry of loaded text-generation pipelines. Each (model_name, dtype,
+# device, backend, compile, draft) is loaded once, lazily and thread-safely, and shared
+# by every caller (CLI, Streamlit sessions, handler). Least recently used models are
+# evicted beyond MAX_LOADED_MODELS.
+DEFAULT_MODEL = "distilgpt2"
+MAX_LOADED_MODELS = int(os.environ.get("TENDER_LLM_MAX_MODELS", "1"))
+# Draft model for assisted generation (see speculative.py), e.g. distilgpt2 for gpt2-medium
+DRAFT_MODEL = os.environ.get("TENDER_LLM_DRAFT_MODEL") or None
+
+
+def _load_model(model_name, dtype, device, backend, compile):
+    # model_name may also be a directory written by snapshot.build_snapshot
+    if is_snapshot(model_name):
+        tokenizer, model = load_snapshot(model_name, dtype)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype)
+    if device is not None:
+        model.to(device)
+    model, backend, report = prepare_model(model, tokenizer, backend, compile)
+    return tokenizer, model, backend, report
+
+
+def load_pipeline(model_name, dtype=None, device=None, backend=DEFAULT_BACKEND, compile=DEFAULT_COMPILE, draft=None):
+    configure_threads()
+    tokenizer, model, applied, report = _load_model(model_name, dtype, device, backend, compile)
+    nlp = pipeline("text-generation", model=model, tokenizer=tokenizer)
+    # Self-check result of the optimized backend against fp32 (None for plain fp32);
+    # the backend actually in use is part of generation cache keys
+    nlp.backend_report = report
+    nlp.backend = applied
+    nlp.draft_model = None
+    if draft:
+        # The draft proposes token ids the target verifies, so both must use the same vocabulary
+        draft_tokenizer, draft_model, _, _ = _load_model(draft, dtype, device, backend, compile)
+        if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+            raise ValueError(f"Draft model {draft} does not share the tokenizer of {model_name}")
+        nlp.draft_model = prepare_draft(draft_model)
+    return nlp
+
+
+def model_id(nlp):
+    # Model name plus CPU backend, since quantized or bf16 weights generate different text
+    return f"{nlp.model.config.name_or_path}:{getattr(nlp, 'backend', 'fp32')}"
+
+
+class ModelRegistry:
+    def __init__(self, max_models=MAX_LOADED_MODELS, loader=load_pipeline):
+        self.max_models = max_models
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._loaded = OrderedDict()
+        self._loading = {}
+
+    def get(self, model_name=DEFAULT_MODEL, dtype=None, device=None, backend=DEFAULT_BACKEND, compile=DEFAULT_COMPILE,
+            draft=None):
+        key = (model_name, str(dtype), str(device), backend, compile, draft)
+        with self._lock:
+            if key in self._loaded:
+                self._loaded.move_to_end(key)
+                return self._loaded[key]
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        # Only one thread loads a given key; the others wait here and then find it loaded
+        with key_lock:
+            with self._lock:
+                if key in self._loaded:
+                    self._loaded.move_to_end(key)
+                    return self._loaded[key]
+            nlp = self.loader(model_name, dtype, device, backend, compile, draft)
+            with self._lock:
+                self._loaded[key] = nlp
+                self._loading.pop(key, None)
+                evicted = []
+                while len(self._loaded) > self.max_models:
+                    evicted.append(self._loaded.popitem(last=False))
+            if evicted:
+                # Callers still holding an evicted pipeline keep it alive until they finish
+                del evicted
+                _release_memory()
+            return nlp
+
+    def loaded(self):
+        with self._lock:
+            return list(self._loaded)
+
+    def evict(self, model_name=None):
+        # Drop every loaded variant of model_name, or everything when model_name is None
+        with self._lock:
+            for key in [k for k in self._loaded if model_name is None or k[0] == model_name]:
+                del self._loaded[key]
+        _release_memory()
+
+
+def _release_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+REGISTRY = ModelRegistry()
+
+
+def get_pipeline(model_name=DEFAULT_MODEL, dtype=None, device=None, backend=DEFAULT_BACKEND, compile=DEFAULT_COMPILE,
+                 draft=None):
+    return REGISTRY.get(model_name, dtype, device, backend, compile, draft)
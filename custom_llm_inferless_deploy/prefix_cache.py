@@ -0,0 +1,49 @@
+import copy
+import threading
+from collections import OrderedDict
+
+import torch
+
+from model_registry import model_id
+
+# In-memory store of past_key_values for shared prompt prefixes (instruction text plus
+# schema). The prefix is run through the model once per (model, prefix) and every
+# generation starts from a copy, so only the chunk text and new tokens are prefilled.
+MAX_PREFIXES = 32
+
+
+class PrefixCache:
+    def __init__(self, max_entries=MAX_PREFIXES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, nlp, prefix_ids):
+        key = (model_id(nlp), tuple(prefix_ids))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        model = nlp.model
+        with torch.inference_mode():
+            past = model(torch.tensor([list(prefix_ids)], device=model.device), use_cache=True).past_key_values
+        with self._lock:
+            self._entries[key] = past
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return past
+
+    def past_for_batch(self, nlp, prefix_ids, batch_size):
+        # A private copy, repeated along the batch dimension; generate() appends to the
+        # cache it is given, so the stored prefix must never be handed out directly
+        past = copy.deepcopy(self._get(nlp, prefix_ids))
+        if batch_size == 1:
+            return past
+        if hasattr(past, "batch_repeat_interleave"):
+            past.batch_repeat_interleave(batch_size)
+            return past
+        return tuple(tuple(t.repeat(batch_size, 1, 1, 1) for t in layer) for layer in past)
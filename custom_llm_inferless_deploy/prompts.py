@@ -0,0 +1,68 @@
+import json
+from functools import lru_cache
+
+from keyword_index import heading_name, heading_paths
+
+# Compact prompt: only the headings routed to a chunk, as a minified key-only
+# schema, so the document text gets most of the context window
+TARGETED_HEADER = (
+    "You are an expert tender document analyst. From the tender text below, extract the "
+    "information for each heading in the schema. If nothing is found for a heading, write \"Not found\".\n"
+    "Schema: {schema}\n"
+    "Text:\n\"\"\"\n"
+)
+TARGETED_FOOTER = "\n\"\"\"\nJSON:"
+
+
+def compact_schema(criteria, headings=None):
+    # Criteria shape restricted to the given dotted heading names, with empty values
+    schema = {}
+    for path, _ in heading_paths(criteria):
+        if headings is not None and heading_name(path) not in headings:
+            continue
+        node = schema
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = ""
+    return schema
+
+
+class PromptBuilder:
+    # Builds targeted prompts as token ids; the header for each heading set is
+    # rendered and tokenized once and reused for every chunk routed to it
+
+    def __init__(self, tokenizer, criteria, cache_size=128):
+        self.tokenizer = tokenizer
+        self.criteria = criteria
+        self.all_headings = tuple(heading_name(path) for path, _ in heading_paths(criteria))
+        self.footer_ids = self._encode(TARGETED_FOOTER)
+        self._prefix = lru_cache(maxsize=cache_size)(self._build_prefix)
+
+    def _encode(self, text):
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def _key(self, headings):
+        if not headings:
+            return self.all_headings
+        wanted = set(headings)
+        return tuple(h for h in self.all_headings if h in wanted)
+
+    def _build_prefix(self, key):
+        schema = json.dumps(compact_schema(self.criteria, set(key)), separators=(",", ":"))
+        header = TARGETED_HEADER.format(schema=schema)
+        return header, self._encode(header)
+
+    def prefix(self, headings=None):
+        return self._prefix(self._key(headings))
+
+    def header_tokens(self):
+        # Worst case (every heading routed to the chunk), used to size chunks
+        return len(self.prefix()[1]) + len(self.footer_ids)
+
+    def build(self, text, headings=None):
+        prefix_text, prefix_ids = self.prefix(headings)
+        return {
+            "prompt": prefix_text + text + TARGETED_FOOTER,
+            "input_ids": prefix_ids + self._encode(text) + self.footer_ids,
+            "prefix_len": len(prefix_ids),
+        }
@@ -0,0 +1,189 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+from cpu_backend import DEFAULT_BACKEND, DEFAULT_COMPILE
+
+# Data-parallel generation across CPU cores. A small model's intra-op threading stops
+# scaling long before a large box runs out of cores, so instead N replicas run in worker
+# processes, each pinned to its own slice of cores with a matching torch thread count.
+# Every replica loads the same safetensors snapshot through copy-on-write memory maps,
+# so the weights exist once in physical memory however many replicas there are.
+# Batches go to the replica with the least outstanding work (prompt + new tokens).
+DEFAULT_THREADS_PER_REPLICA = int(os.environ.get("TENDER_LLM_THREADS_PER_REPLICA", "4"))
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def core_slices(replicas=None, threads_per_replica=DEFAULT_THREADS_PER_REPLICA, cores=None):
+    # Split the usable cores into contiguous slices, one per replica, as evenly as possible;
+    # with more replicas than cores, replicas share cores round-robin
+    cores = cores or available_cores()
+    replicas = replicas or max(1, len(cores) // threads_per_replica)
+    base, extra = divmod(len(cores), replicas)
+    slices, start = [], 0
+    for i in range(replicas):
+        size = base + (i < extra)
+        slices.append(cores[start:start + size] or [cores[i % len(cores)]])
+        start += size
+    return slices
+
+
+def _replica_worker(index, model_name, backend, compile, draft, cores, tasks, results):
+    # Pin before torch starts its thread pools, then serve generate_batch calls until None
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    os.environ["TENDER_LLM_THREADS"] = str(len(cores))
+    from metrics import Metrics
+    from model_registry import get_pipeline
+    from prefix_cache import PrefixCache
+    from tender_pipeline import generate_batch, prepare_batching
+
+    try:
+        nlp = get_pipeline(model_name, backend=backend, compile=compile, draft=draft)
+        prepare_batching(nlp.tokenizer, nlp.model)
+    except Exception as e:
+        results.put((None, index, f"{type(e).__name__}: {e}", None))
+        return
+    prefix_cache = PrefixCache()
+    results.put((None, index, None, None))
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, batch_ids, max_new_tokens, schemas, prefix_len = task
+        metrics = Metrics()
+        try:
+            texts = generate_batch(nlp, batch_ids, max_new_tokens, schemas, prefix_len, prefix_cache, metrics)
+        except Exception as e:
+            results.put((task_id, index, RuntimeError(f"replica {index}: {type(e).__name__}: {e}"), None))
+        else:
+            results.put((task_id, index, texts, metrics.as_dict()))
+
+
+class ReplicaPool:
+    def __init__(self, model_name, replicas=None, threads_per_replica=DEFAULT_THREADS_PER_REPLICA,
+                 backend=DEFAULT_BACKEND, draft=None, compile=DEFAULT_COMPILE):
+        from snapshot import ensure_snapshot
+
+        self.model_name = ensure_snapshot(model_name)
+        self.slices = core_slices(replicas, threads_per_replica)
+        context = multiprocessing.get_context("spawn")
+        self._results = context.Queue()
+        self._tasks = [context.Queue() for _ in self.slices]
+        self._load = [0] * len(self.slices)
+        self._pending = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._workers = [
+            context.Process(
+                target=_replica_worker,
+                args=(i, self.model_name, backend, compile, draft, cores, self._tasks[i], self._results),
+                daemon=True,
+            )
+            for i, cores in enumerate(self.slices)
+        ]
+        for worker in self._workers:
+            worker.start()
+        # Wait until every replica has loaded, so start-up errors surface here
+        ready = 0
+        while ready < self.size:
+            try:
+                _, index, error, _ = self._results.get(timeout=1)
+            except queue.Empty:
+                error = self._check_workers()
+                index = None
+            else:
+                ready += 1
+            if error is not None:
+                self.close()
+                raise RuntimeError(f"Replica {index} failed to load {self.model_name}: {error}")
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    @property
+    def size(self):
+        return len(self._workers)
+
+    def submit(self, batch_ids, max_new_tokens, schemas=None, prefix_len=0, metrics=None):
+        # Same arguments as tender_pipeline.generate_batch; returns a Future of the texts
+        cost = len(batch_ids) * (max(len(ids) for ids in batch_ids) + max_new_tokens)
+        future = Future()
+        with self._lock:
+            replica = min(range(self.size), key=lambda i: self._load[i])
+            if self._load[replica] == float("inf"):
+                raise RuntimeError("No live replicas")
+            task_id = next(self._ids)
+            self._load[replica] += cost
+            self._pending[task_id] = (future, replica, cost, metrics)
+        batch_ids = [list(ids) for ids in batch_ids]
+        self._tasks[replica].put((task_id, batch_ids, max_new_tokens, schemas, prefix_len))
+        return future
+
+    def _check_workers(self):
+        # A replica that died (e.g. OOM-killed) fails its queued batches and gets no more
+        dead = [i for i, worker in enumerate(self._workers) if not worker.is_alive() and self._load[i] != float("inf")]
+        if not dead:
+            return None
+        with self._lock:
+            for i in dead:
+                self._load[i] = float("inf")
+            failed = [(task_id, entry) for task_id, entry in self._pending.items() if entry[1] in dead]
+            for task_id, _ in failed:
+                del self._pending[task_id]
+        for _, (future, replica, _, _) in failed:
+            future.set_exception(RuntimeError(f"replica {replica} exited with code {self._workers[replica].exitcode}"))
+        return f"replica(s) {dead} exited"
+
+    def _collect(self):
+        while True:
+            try:
+                task_id, index, texts, report = self._results.get(timeout=1)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if task_id is None:
+                if index is None:
+                    return
+                continue
+            with self._lock:
+                entry = self._pending.pop(task_id, None)
+                if entry is None:
+                    continue
+                future, replica, cost, metrics = entry
+                self._load[replica] -= cost
+            if isinstance(texts, Exception):
+                future.set_exception(texts)
+                continue
+            if metrics is not None:
+                for stage, seconds in report["seconds"].items():
+                    metrics.add_time(stage, seconds)
+                for name, n in report["counts"].items():
+                    metrics.count(name, n)
+            future.set_result(texts)
+
+    def loads(self):
+        with self._lock:
+            return list(self._load)
+
+    def close(self):
+        for tasks in self._tasks:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self._results.put((None, None, None, None))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,160 @@
+import re
+from collections import Counter
+
+from keyword_index import heading_name, heading_paths
+
+# Rule-based fast path for the criteria that tenders state formulaically ("EMD of
+# Rs. 5,00,000/-", "completion period of 18 (eighteen) months"). Each field's CRITERIA
+# keywords are compiled into one regex, and the first amount, percentage or duration
+# shortly after a keyword is taken as its value. A chunk's field is only resolved here
+# when the match is close to the keyword and unambiguous; otherwise it stays with the LLM.
+AMOUNT, PERCENT, DURATION = "amount", "percent", "duration"
+RULE_FIELDS = {
+    "specific_criteria.turnover": (AMOUNT,),
+    "specific_criteria.emd_submission": (AMOUNT, PERCENT),
+    "specific_criteria.completion_period": (DURATION,),
+    "specific_criteria.performance_security": (PERCENT, AMOUNT),
+    "specific_criteria.defect_liability": (DURATION,),
+}
+MAX_VALUE_DISTANCE = 200
+CONFIDENCE_THRESHOLD = 0.8
+
+VALUE_PATTERNS = {
+    AMOUNT: re.compile(
+        r"(?P<currency>Rs\.?|INR|₹)?\s*"
+        # Western grouping first, so 1,250,000 is not read as Indian-grouped 1,250
+        r"(?P<number>\d{1,3}(?:,\d{3})+(?!\d)|\d{1,3}(?:,\d{2})*,\d{3}(?!\d)|\d+)(?:\.(?P<decimals>\d+))?"
+        r"\s*(?:/-)?\s*(?P<unit>lakhs?\b|lacs?\b|crores?\b|cr\b\.?|millions?\b)?"
+        r"(?:\s*(?P<suffix>INR\b|rupees\b))?",
+        re.IGNORECASE,
+    ),
+    PERCENT: re.compile(r"(?P<number>\d+(?:\.\d+)?)\s*(?:%|per\s*cent\b|percent\b)", re.IGNORECASE),
+    DURATION: re.compile(
+        r"(?P<number>\d+)\s*(?:\(\s*[a-z][a-z\- ]*\)\s*)?(?:calendar\s+)?(?P<unit>days?|weeks?|months?|years?)\b",
+        re.IGNORECASE,
+    ),
+}
+UNIT_MULTIPLIERS = {"lakh": 10**5, "lac": 10**5, "crore": 10**7, "cr": 10**7, "million": 10**6}
+PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n|\f")
+
+
+def indian_grouping(n):
+    # 12500000 -> "1,25,00,000"
+    digits = str(n)
+    if len(digits) <= 3:
+        return digits
+    head, tail = digits[:-3], digits[-3:]
+    groups = []
+    while len(head) > 2:
+        groups.insert(0, head[-2:])
+        head = head[:-2]
+    if head:
+        groups.insert(0, head)
+    return ",".join(groups + [tail])
+
+
+def _amount(match):
+    # None for bare numbers (clause numbers, dates) without a currency or a unit
+    unit = (match.group("unit") or "").lower().rstrip(".")
+    if not (match.group("currency") or match.group("suffix") or unit):
+        return None
+    rupees = float(match.group("number").replace(",", "") + "." + (match.group("decimals") or "0"))
+    for name, multiplier in UNIT_MULTIPLIERS.items():
+        if unit.startswith(name):
+            rupees *= multiplier
+            break
+    return f"Rs. {indian_grouping(round(rupees))}"
+
+
+def _number(text):
+    return text.rstrip("0").rstrip(".") if "." in text else text
+
+
+def _format(kind, match):
+    if kind == AMOUNT:
+        return _amount(match)
+    if kind == PERCENT:
+        return f"{_number(match.group('number'))}%"
+    number = int(match.group("number"))
+    unit = match.group("unit").lower().rstrip("s")
+    return f"{number} {unit}" if number == 1 else f"{number} {unit}s"
+
+
+class RuleExtractor:
+    def __init__(self, criteria, fields=RULE_FIELDS, threshold=CONFIDENCE_THRESHOLD):
+        self.threshold = threshold
+        self.rules = []
+        for path, keywords in heading_paths(criteria):
+            name = heading_name(path)
+            keywords = sorted({" ".join(k.lower().split()) for k in keywords if k.strip()}, key=len, reverse=True)
+            if name not in fields or not keywords:
+                continue
+            alternatives = "|".join(r"\s+".join(map(re.escape, k.split())) for k in keywords)
+            self.rules.append((name, re.compile(rf"(?<!\w)(?:{alternatives})(?!\w)", re.IGNORECASE), fields[name]))
+
+    @property
+    def headings(self):
+        return [name for name, _, _ in self.rules]
+
+    def _value_after(self, text, end, kinds):
+        # First value of an allowed kind after a keyword, within the same paragraph
+        window = text[end:end + MAX_VALUE_DISTANCE]
+        brk = PARAGRAPH_BREAK.search(window)
+        if brk:
+            window = window[:brk.start()]
+        best = None
+        for kind in kinds:
+            for match in VALUE_PATTERNS[kind].finditer(window):
+                value = _format(kind, match)
+                if value is not None:
+                    if best is None or match.start() < best[1]:
+                        best = (value, match.start())
+                    break
+        return best
+
+    def extract(self, text):
+        # {heading: {"value", "confidence", "matches"}} for every rule field with a match;
+        # confidence drops with the keyword-value distance and with disagreeing matches
+        findings = {}
+        for name, pattern, kinds in self.rules:
+            values, scores = [], []
+            for match in pattern.finditer(text):
+                found = self._value_after(text, match.end(), kinds)
+                if found is None:
+                    continue
+                value, distance = found
+                values.append(value)
+                scores.append(0.95 if distance <= 40 else 0.85 if distance <= 120 else 0.6)
+            if not values:
+                continue
+            value, count = Counter(values).most_common(1)[0]
+            best = max(s for v, s in zip(values, scores) if v == value)
+            findings[name] = {
+                "value": value,
+                "confidence": round(best * count / len(values), 3),
+                "matches": len(values),
+            }
+        return findings
+
+    def resolve(self, text):
+        # Only the findings confident enough to skip the LLM for that heading
+        return {name: f for name, f in self.extract(text).items() if f["confidence"] >= self.threshold}
+
+
+def apply_findings(parsed, findings):
+    # Write resolved findings (keyed by dotted heading name) into a parsed chunk output,
+    # overriding the model's values for those headings
+    if not findings:
+        return parsed
+    parsed = dict(parsed) if isinstance(parsed, dict) else {}
+    for name, finding in findings.items():
+        *parents, leaf = name.split(".")
+        node = parsed
+        for key in parents:
+            if not isinstance(node.get(key), dict):
+                node[key] = {}
+            else:
+                node[key] = dict(node[key])
+            node = node[key]
+        node[leaf] = finding["value"]
+    return parsed
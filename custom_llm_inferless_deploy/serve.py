@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import handler
+from metrics import METRICS
+
+# Long-running HTTP front-end for the handler: concurrent requests are queued and
+# dispatched to the shared pipeline as micro-batches bounded by size and wait time.
+MAX_BATCH_SIZE = 8
+MAX_WAIT_MS = 20
+
+
+class MicroBatcher:
+    def __init__(self, infer, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.infer = infer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        # One worker thread: the model is shared, batching is where the parallelism comes from
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._worker = None
+
+    def start(self):
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, request):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def _collect(self):
+        # Block for the first request, then take whatever else arrives before the deadline
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            # Only requests with the same options can share a generate call
+            groups = {}
+            for request, future in batch:
+                options = (request.get("prompt_mode"), request.get("use_cache", True), request.get("constrained", True),
+                           request.get("rules", True), bool(request.get("retrieval")), request.get("batch_size"),
+                           request.get("memory_budget_mb"))
+                groups.setdefault(options, []).append((request, future))
+            for options, items in groups.items():
+                try:
+                    await self._infer(options, items)
+                except Exception as e:
+                    if len(items) == 1:
+                        if not items[0][1].done():
+                            items[0][1].set_exception(e)
+                        continue
+                    # Something in the merged call failed: run the members one at a time so
+                    # only the request that caused it gets the error
+                    for request, future in items:
+                        try:
+                            await self._infer(options, [(request, future)])
+                        except Exception as e:
+                            if not future.done():
+                                future.set_exception(e)
+
+    async def _infer(self, options, items):
+        # One generate call for requests with the same options; each caller gets its slice
+        prompt_mode, use_cache, constrained, rules, retrieval, batch_size, memory_budget_mb = options
+        texts = []
+        spans = []
+        for request, _ in items:
+            request_texts = request["texts"] if "texts" in request else [request.get("text", "")]
+            spans.append((len(texts), len(request_texts)))
+            texts.extend(request_texts)
+        merged = {
+            "texts": texts,
+            "prompt_mode": prompt_mode,
+            "use_cache": use_cache,
+            "constrained": constrained,
+            "rules": rules,
+            "retrieval": retrieval,
+            "batch_size": batch_size if batch_size is not None else self.max_batch_size,
+            "metrics": any(request.get("metrics") for request, _ in items),
+        }
+        if memory_budget_mb is not None:
+            merged["memory_budget_mb"] = memory_budget_mb
+        response = await asyncio.get_running_loop().run_in_executor(self.executor, self.infer, merged)
+        outputs = response["outputs"]
+        for (request, future), (start, count) in zip(items, spans):
+            if future.done():
+                continue
+            if "texts" in request:
+                result = {"outputs": outputs[start:start + count]}
+            else:
+                result = dict(outputs[start])
+            if request.get("metrics"):
+                # Timings cover the whole micro-batch this request was generated in
+                result["metrics"] = dict(response["metrics"], batched_requests=len(items))
+            future.set_result(result)
+
+
+async def _read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, body
+
+
+async def _write_response(writer, status, payload, content_type="application/json"):
+    body = payload.encode("utf-8") if isinstance(payload, str) else json.dumps(payload).encode("utf-8")
+    reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}[status]
+    writer.write(
+        f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+    writer.close()
+
+
+async def _stream_response(writer, events):
+    # NDJSON over chunked transfer encoding; the blocking generator is advanced on a worker thread
+    loop = asyncio.get_running_loop()
+    writer.write(
+        b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+        b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+    )
+    done = object()
+    try:
+        while True:
+            event = await loop.run_in_executor(None, next, events, done)
+            if event is done:
+                break
+            line = json.dumps(event).encode("utf-8") + b"\n"
+            writer.write(f"{len(line):x}\r\n".encode("latin-1") + line + b"\r\n")
+            await writer.drain()
+    except Exception as e:
+        line = json.dumps({"event": "error", "error": str(e)}).encode("utf-8") + b"\n"
+        writer.write(f"{len(line):x}\r\n".encode("latin-1") + line + b"\r\n")
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+    writer.close()
+
+
+def make_handler(batcher):
+    async def handle(reader, writer):
+        try:
+            parsed = await _read_request(reader)
+            if parsed is None:
+                writer.close()
+                return
+            method, path, body = parsed
+            if method == "GET" and path == "/health":
+                await _write_response(writer, 200, {"status": "ok", "queued": batcher.queue.qsize(),
+                                                   "startup": handler.STARTUP})
+            elif method == "GET" and path == "/metrics":
+                await _write_response(writer, 200, METRICS.prometheus_text(handler.cache_counters()),
+                                      "text/plain; version=0.0.4")
+            elif method in ("GET", "DELETE") and path.startswith("/jobs/"):
+                job_id = path[len("/jobs/"):]
+                status = handler.job_status(job_id)
+                if status is None:
+                    await _write_response(writer, 404, {"error": f"No job {job_id}"})
+                elif method == "DELETE":
+                    await _write_response(writer, 200, handler.cancel_job(job_id))
+                else:
+                    await _write_response(writer, 200, status)
+            elif method == "POST" and path in ("/infer", "/infer/stream", "/jobs"):
+                try:
+                    request = json.loads(body or b"{}")
+                    # Checked here, before a request can be merged into a micro-batch
+                    handler.validate_request(request, job=path == "/jobs")
+                except json.JSONDecodeError as e:
+                    await _write_response(writer, 400, {"error": f"Invalid JSON body: {e}"})
+                    return
+                except ValueError as e:
+                    await _write_response(writer, 400, {"error": str(e)})
+                    return
+                if path == "/jobs":
+                    await _write_response(writer, 200, handler.submit_job(request))
+                elif path == "/infer/stream":
+                    # Streaming requests bypass micro-batching
+                    await _stream_response(writer, handler.infer_stream(request))
+                else:
+                    await _write_response(writer, 200, await batcher.submit(request))
+            else:
+                await _write_response(writer, 404, {"error": f"No route for {method} {path}"})
+        except Exception as e:
+            await _write_response(writer, 500, {"error": str(e)})
+    return handle
+
+
+async def serve(host, port, max_batch_size, max_wait_ms, warmup=True):
+    if warmup:
+        # Load and exercise the model before accepting connections
+        startup = await asyncio.get_running_loop().run_in_executor(None, handler.warmup)
+        print(f"Warm: {startup}")
+    # Jobs interrupted by the last shutdown start running again in the background
+    handler.job_queue()
+    batcher = MicroBatcher(handler.infer, max_batch_size, max_wait_ms)
+    batcher.start()
+    server = await asyncio.start_server(make_handler(batcher), host, port)
+    print(f"Serving on http://{host}:{port} (max batch {max_batch_size}, max wait {max_wait_ms} ms)")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-batching HTTP server for the tender extraction handler")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    parser.add_argument("--no-warmup", action="store_true", help="load the model on the first request instead")
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.max_batch_size, args.max_wait_ms, not args.no_warmup))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+
+# Local, pre-serialized copy of a model for fast cold starts. build_snapshot() is run once
+# (e.g. while building the deployment image) and writes the tokenizer and the weights as
+# safetensors, which are memory-mapped at load time instead of being read into a fresh
+# buffer. snapshot.json records the source model so cache keys stay the same as for the
+# Hub model.
+SNAPSHOT_INFO = "snapshot.json"
+DEFAULT_SNAPSHOT_ROOT = os.path.join(os.path.expanduser("~"), ".cache", "tender_llm", "snapshots")
+SAFETENSORS_DTYPES = {
+    "F64": "float64", "F32": "float32", "F16": "float16", "BF16": "bfloat16",
+    "I64": "int64", "I32": "int32", "I16": "int16", "I8": "int8", "U8": "uint8", "BOOL": "bool",
+}
+
+
+def is_snapshot(path):
+    return os.path.isfile(os.path.join(path, SNAPSHOT_INFO))
+
+
+def build_snapshot(model_name, path, dtype=None):
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype)
+    os.makedirs(path, exist_ok=True)
+    tokenizer.save_pretrained(path)
+    model.save_pretrained(path, safe_serialization=True)
+    with open(os.path.join(path, SNAPSHOT_INFO), "w", encoding="utf-8") as f:
+        json.dump({"model_name": model_name, "dtype": str(model.dtype)}, f)
+    return path
+
+
+def ensure_snapshot(model_name, root=DEFAULT_SNAPSHOT_ROOT):
+    # Snapshot directory for model_name, building it on first use
+    if is_snapshot(model_name):
+        return model_name
+    path = os.path.join(root, model_name.replace("/", "--"))
+    if not is_snapshot(path):
+        build_snapshot(model_name, path)
+    return path
+
+
+def mmap_state_dict(path):
+    # Tensors that point straight into copy-on-write memory maps of the snapshot's
+    # safetensors files: nothing is read up front, and processes mapping the same file
+    # share its pages in the OS page cache until one of them writes to a tensor
+    import torch
+
+    state, maps = {}, []
+    for filename in sorted(glob.glob(os.path.join(path, "*.safetensors"))):
+        with open(filename, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        maps.append(buffer)
+        (header_len,) = struct.unpack("<Q", buffer[:8])
+        header = json.loads(buffer[8:8 + header_len])
+        header.pop("__metadata__", None)
+        for name, entry in header.items():
+            dtype = getattr(torch, SAFETENSORS_DTYPES[entry["dtype"]])
+            start, end = entry["data_offsets"]
+            count = (end - start) // torch.empty((), dtype=dtype).element_size()
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=count, offset=8 + header_len + start)
+            state[name] = tensor.reshape(entry["shape"])
+    return state, maps
+
+
+def load_snapshot(path, dtype=None):
+    # The model is built without initialising its weights and the memory-mapped tensors
+    # are assigned in place of its parameters, so loading copies nothing and replicas in
+    # other processes share one physical copy (converting to another dtype makes a copy)
+    from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+    from transformers.modeling_utils import no_init_weights
+
+    with open(os.path.join(path, SNAPSHOT_INFO), encoding="utf-8") as f:
+        info = json.load(f)
+    tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=True)
+    config = AutoConfig.from_pretrained(path, local_files_only=True)
+    with no_init_weights():
+        model = AutoModelForCausalLM.from_config(config)
+    state, maps = mmap_state_dict(path)
+    missing = model.load_state_dict(state, strict=False, assign=True).missing_keys
+    model.tie_weights()
+    untied = [k for k in missing if k not in (getattr(model, "_tied_weights_keys", None) or [])]
+    if untied:
+        raise ValueError(f"Snapshot {path} has no weights for {', '.join(untied)}")
+    # The tensors borrow the maps' memory; keep them open for the model's lifetime
+    model._snapshot_maps = maps
+    if dtype is not None:
+        model.to(dtype)
+    model.config.name_or_path = info["model_name"]
+    return tokenizer, model.eval()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python snapshot.py <model_name> <snapshot_dir>")
+        sys.exit(1)
+    print(f"Snapshot of {sys.argv[1]} written to {build_snapshot(sys.argv[1], sys.argv[2])}")
@@ -0,0 +1,63 @@
+import os
+import threading
+
+# Assisted (speculative) generation. A small draft model that shares the target's
+# tokenizer (distilgpt2 next to gpt2-medium, say) proposes a few tokens at a time and the
+# target model checks them all in one forward pass, keeping the longest prefix it agrees
+# with plus one token of its own. Greedy assisted decoding produces exactly the target
+# model's output, so cache keys do not change; it only pays off when most drafted tokens
+# are accepted, which the compact, repetitive JSON outputs make likely. The draft model is
+# loaded with the pipeline (model_registry.load_pipeline(..., draft=...)) and stored as
+# nlp.draft_model.
+# Tokens drafted per verification step to start with; transformers adapts the number
+# as drafts are accepted or rejected
+DRAFT_TOKENS = int(os.environ.get("TENDER_LLM_DRAFT_TOKENS", "5"))
+
+
+def prepare_draft(draft, draft_tokens=DRAFT_TOKENS):
+    # transformers reads the draft length from the draft model's own generation config
+    draft.generation_config.num_assistant_tokens = draft_tokens
+    return draft
+
+
+def assisted_kwargs(nlp):
+    # Extra model.generate() arguments; empty when the pipeline has no draft model
+    draft = getattr(nlp, "draft_model", None)
+    if draft is None:
+        return {}
+    return {"assistant_model": draft}
+
+
+class DraftCounter:
+    # Counts forward passes of the draft model made by the current thread while active;
+    # each one proposes a single token. A no-op without a draft model.
+    def __init__(self, draft):
+        self.draft = draft
+        self.calls = 0
+        self._handle = None
+        self._thread = None
+
+    def _hook(self, module, args, output):
+        if threading.get_ident() == self._thread:
+            self.calls += 1
+
+    def __enter__(self):
+        if self.draft is not None:
+            self._thread = threading.get_ident()
+            self._handle = self.draft.register_forward_hook(self._hook)
+        return self
+
+    def __exit__(self, *exc):
+        if self._handle is not None:
+            self._handle.remove()
+            self._handle = None
+
+
+def record_acceptance(metrics, drafted, generated, steps):
+    # Each verification step of the target model contributes one token of its own (the
+    # correction or the token after a fully accepted draft); the other generated tokens
+    # are accepted drafts
+    metrics.count("draft_tokens", drafted)
+    metrics.count("accepted_draft_tokens", max(0, generated - steps))
+    metrics.count("target_steps", steps)
+